@@ -26,6 +26,10 @@ const kMinHeartbeatDelay = 5 * kSeconds;
 const kMaxHeartbeatDelay = 5 * kMinutes;
 const kMinErrorDelay = 5 * kSeconds;
 const kMaxErrorDelay = 5 * kHours;
+// How long the server may hold a request while waiting for changes.
+const kLongPollSeconds = 30;
+// Initial syncs are fetched in pages of this many rows.
+const kSyncPageSize = 1000;
 class Connection {
     constructor(data) {
         this.data = data;
@@ -38,6 +42,11 @@ class Connection {
         this.last_commit = 0;
         this.prefix = "";
         this.queued_requests = 0;
+        // Set when the server supports holding 'api/get' until there are changes.
+        this.long_poll = false;
+        this.poll_controller = null;
+        // The query of a paged sync that's in progress.
+        this.page_query = null;
         data.connection = this;
     }
     checkPrefix() {
@@ -69,7 +78,13 @@ class Connection {
             this.queued_requests |= request_type;
             if (this.next_tick === 0) {
                 // There's currently a request in flight.
-                this.delay = 0;
+                if (this.poll_controller) {
+                    // It's a long poll, cut it short; that calls {entryPoint}.
+                    this.poll_controller.abort();
+                }
+                else {
+                    this.delay = 0;
+                }
             }
             else if (this.next_tick === -1) {
                 // Auto-sync disabled.
@@ -105,12 +120,16 @@ class Connection {
     }
     onReceivedData() {
         this.registerSuccess();
-        this.delay = kMinHeartbeatDelay;
+        this.delay = this.long_poll ? 0 : kMinHeartbeatDelay;
         this.loop();
     }
     onNoData() {
         this.registerSuccess();
-        if (this.delay < kMinHeartbeatDelay) {
+        if (this.long_poll) {
+            // The server already waited for us.
+            this.delay = 0;
+        }
+        else if (this.delay < kMinHeartbeatDelay) {
             this.delay = kMinHeartbeatDelay;
         }
         else {
@@ -129,10 +148,15 @@ class Connection {
     }
     entryPoint() {
         this.next_tick = 0;
+        if (this.page_query !== null) {
+            // Also resumes after errors.
+            return this.sendGet('api/get', this.page_query);
+        }
         if (this.queued_requests & RequestType.kFetchAll) {
             console.log('Special request: FetchAll');
             this.queued_requests &= ~RequestType.kFetchAll;
-            return this.sendGet('api/get', { last_commit: 0 });
+            this.page_query = { last_commit: 0, page_size: kSyncPageSize };
+            return this.sendGet('api/get', this.page_query);
         }
         if (this.queued_requests & RequestType.kPushAll) {
             console.log('Special request: PushAll');
@@ -150,8 +174,15 @@ class Connection {
             console.log('Sending updates to server');
             return this.sendPost(updates);
         }
+        if (this.last_commit === 0) {
+            console.log('Fetching all data from server');
+            this.page_query = { last_commit: 0, page_size: kSyncPageSize, delta: 1 };
+            return this.sendGet('api/get', this.page_query);
+        }
         console.log('Fetching data from server');
-        this.sendGet('api/get', { last_commit: this.last_commit });
+        // With delta=1, the server only sends the fields that changed.
+        this.sendGet('api/get', { last_commit: this.last_commit,
+            wait: kLongPollSeconds, delta: 1 }, true);
     }
     processResponse(response) {
         if (this.processUuid(response))
@@ -160,6 +191,15 @@ class Connection {
             return;
         let had_receipts = this.processReceipts(response.receipts);
         let had_data = this.processData(response);
+        if (this.page_query !== null) {
+            if (response.next_page_token) {
+                // More pages to come, fetch them right away.
+                this.page_query.page_token = response.next_page_token;
+                this.entryPoint();
+                return;
+            }
+            this.page_query = null;
+        }
         if (had_receipts) {
             // We sent updates, see if there are more.
             this.entryPoint();
@@ -461,7 +501,8 @@ class Connection {
                 this.data.persistNextLogId();
         }
         let commit = response.commit;
-        if (commit !== this.last_commit) {
+        // Only the last page of a paged sync has a commit.
+        if (commit !== undefined && commit !== this.last_commit) {
             this.last_commit = commit;
             this.data.setLastServerCommit(commit);
             return true;
@@ -562,7 +603,7 @@ class Connection {
             this.processError(error);
         });
     }
-    sendGet(path, query = null) {
+    sendGet(path, query = null, long_poll = false) {
         let str = [];
         if (query) {
             for (var p of Object.keys(query)) {
@@ -572,14 +613,30 @@ class Connection {
             }
             path += '?' + str.join('&');
         }
-        fetch(this.prefix + path).then((response) => {
+        let init = {};
+        if (long_poll) {
+            this.poll_controller = new AbortController();
+            init.signal = this.poll_controller.signal;
+        }
+        fetch(this.prefix + path, init).then((response) => {
             if (!response.ok)
                 throw new Error('Network response was not ok');
             return response.json();
         }).then((response) => {
             console.log('GET success: ' + JSON.stringify(response));
+            if (long_poll) {
+                this.poll_controller = null;
+                this.long_poll = !!response.long_poll;
+            }
             this.processResponse(response);
         }, (error) => {
+            if (long_poll && this.poll_controller &&
+                this.poll_controller.signal.aborted) {
+                // Interrupted by {kick}, there is other work to do.
+                this.poll_controller = null;
+                return this.entryPoint();
+            }
+            this.poll_controller = null;
             console.log('GET error: ' + error);
             this.processError(error);
         });
@@ -0,0 +1,47 @@
+import contextlib
+import io
+import json
+import time
+import urllib.error
+import urllib.request
+
+from winedb.aioserver import AsyncWineServer
+from winedb.manager import Manager
+from winedb.server import WineServer
+
+BASEDIR = __file__.rsplit("/", 2)[0]
+
+# The Manager reports progress on stdout.
+def Quietly(function, *args, **kwargs):
+  with contextlib.redirect_stdout(io.StringIO()):
+    return function(*args, **kwargs)
+
+def MakeManager(**options):
+  return Quietly(Manager, ":memory:", **options)
+
+# Starts a server on an in-memory database (with MakeFakeData()) on a free
+# port. Returns the server and a function fetching a path, which returns
+# (status, body).
+def StartServer(engine="threads", **options):
+  server_class = AsyncWineServer if engine == "asyncio" else WineServer
+  server = server_class(0, ":memory:", BASEDIR, **options)
+  Quietly(server.Start)
+  while server.manager is None or server.server_address is None:
+    time.sleep(0.01)
+  base = f"http://127.0.0.1:{server.server_address[1]}"
+  def Fetch(path, data=None, headers=None):
+    request = urllib.request.Request(base + path, data=data,
+                                     headers=headers or {})
+    try:
+      with urllib.request.urlopen(request) as response:
+        return response.status, response.read()
+    except urllib.error.HTTPError as e:
+      return e.code, e.read()
+  return server, Fetch
+
+def StopServer(server):
+  Quietly(server.Shutdown)
+  if isinstance(server, WineServer): server.server_close()
+
+def Json(body):
+  return json.loads(body)
@@ -0,0 +1,169 @@
+import unittest
+
+from tests.helpers import MakeManager
+from winedb.manager import Snapshot
+from winedb.metrics import Metrics
+from winedb.stats import StatsCache
+
+class TimedCursorTest(unittest.TestCase):
+  def setUp(self):
+    self.metrics = Metrics()
+    self.manager = MakeManager(metrics=self.metrics)
+
+  def tearDown(self):
+    self.manager.Shutdown()
+
+  def Observed(self, stmt):
+    return self.metrics._statements.get(stmt, [0, 0.0])[0]
+
+  def testKeepsCursorApi(self):
+    stmt = "SELECT id FROM years ORDER BY id"
+    expected = [row[0] for row in self.manager._conn.execute(stmt)]
+    self.assertTrue(expected)
+    self.assertEqual([row["id"] for row in self.manager.Execute(stmt)],
+                     expected)
+    self.assertEqual(len(self.manager.Execute(stmt).fetchall()),
+                     len(expected))
+    c = self.manager.Execute(stmt)
+    self.assertEqual(c.fetchone()["id"], expected[0])
+    self.assertEqual(len(c.fetchmany(2)), min(2, len(expected) - 1))
+    self.assertIsNotNone(c.description)
+
+  def testObservesOncePerStatement(self):
+    stmt = "SELECT id FROM years"
+    for _ in self.manager.Execute(stmt): pass
+    self.manager.Execute(stmt).fetchall()
+    c = self.manager.Execute(stmt)
+    c.fetchone()
+    self.assertEqual(self.Observed(stmt), 2)
+    del c  # Not exhausted.
+    self.assertEqual(self.Observed(stmt), 3)
+
+  def testObservesStatementsWithoutRows(self):
+    stmt = "SELECT id FROM years WHERE id < 0"
+    self.assertIsNone(self.manager.Execute(stmt).fetchone())
+    self.assertEqual(self.Observed(stmt), 1)
+
+class ApplyStockTest(unittest.TestCase):
+  def setUp(self):
+    self.manager = MakeManager()
+    conn = self.manager._conn
+    self.wine, self.vineyard = conn.execute(
+        "SELECT wines.id, wines.vineyard FROM years "
+        "INNER JOIN wines ON years.wine = wines.id LIMIT 1").fetchone()
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM years WHERE wine IN "
+        "(SELECT id FROM wines WHERE vineyard=?) ORDER BY id",
+        (self.vineyard,))]
+    self.negative, = conn.execute(
+        "SELECT MIN(id) FROM years WHERE wine=?", (self.wine,)).fetchone()
+    self.others = [year_id for year_id in ids if year_id != self.negative]
+    conn.execute("UPDATE years SET count=2, stock=3")
+    conn.execute("UPDATE years SET stock=-1 WHERE id=?", (self.negative,))
+    conn.commit()
+
+  def tearDown(self):
+    self.manager.Shutdown()
+
+  def Check(self, result):
+    self.assertEqual(result[self.negative], {"count": -1})
+    for year_id in self.others:
+      self.assertEqual(result[year_id], {"count": 3})
+    count, = self.manager._conn.execute(
+        "SELECT count FROM years WHERE id=?", (self.negative,)).fetchone()
+    self.assertEqual(count, -1)
+
+  # Years are reported with the stock applied, including negative ones.
+  def testVineyardReportsNegativeStock(self):
+    self.Check(self.manager.ApplyStockVineyard(self.vineyard))
+
+  def testWineReportsNegativeStock(self):
+    result = self.manager.ApplyStockWine(self.wine)
+    self.assertEqual(result[self.negative], {"count": -1})
+
+class SortedPageTest(unittest.TestCase):
+  def setUp(self):
+    self.manager = MakeManager()
+    conn = self.manager._conn
+    ids = [row[0] for row in conn.execute("SELECT id FROM years ORDER BY id")]
+    conn.execute("UPDATE years SET count=1")
+    # Besides numbers, prices can be text or NULL.
+    for year_id in ids[::3]:
+      conn.execute("UPDATE years SET price=NULL WHERE id=?", (year_id,))
+    for year_id in ids[1::5]:
+      conn.execute("UPDATE years SET price='?' WHERE id=?", (year_id,))
+    conn.commit()
+
+  def tearDown(self):
+    self.manager.Shutdown()
+
+  def Pages(self, sortby, limit):
+    ids = []
+    page_token = None
+    while True:
+      page = self.manager.GetSortedPage(1, sortby, limit, page_token)
+      ids.extend(row["year_id"] for row in page["rows"])
+      page_token = page.get("next_page_token")
+      if page_token is None: return ids
+
+  def testPagesCoverTextAndNull(self):
+    for sortby in ("price_asc", "price_desc", "year_desc"):
+      expected = [row["year_id"] for row in self.manager.GetSorted(1, sortby)]
+      prices = {row["price"] for row in self.manager.GetSorted(1, sortby)}
+      self.assertIn(None, prices)
+      self.assertIn("?", prices)
+      for limit in (1, 2, 7):
+        self.assertEqual(self.Pages(sortby, limit), expected, (sortby, limit))
+
+  def testInvalidToken(self):
+    for token in ("abc", "1.5:3", "WzEsIHRydWVd", "WzEsICJ4Il0=", "e30="):
+      with self.assertRaisesRegex(ValueError, "Invalid page token"):
+        self.manager.GetSortedPage(1, "price", 5, token)
+
+class StatsTest(unittest.TestCase):
+  def setUp(self):
+    self.manager = MakeManager(metrics=Metrics())
+
+  def tearDown(self):
+    self.manager.Shutdown()
+
+  # The second call after a write updates the cached groups incrementally.
+  def testUpdateWithMetrics(self):
+    before = self.manager.GetStats()
+    year_id, = self.manager._conn.execute(
+        "SELECT id FROM years WHERE count > 0 LIMIT 1").fetchone()
+    self.manager.AddOneBottle(year_id, 1)
+    after = self.manager.GetStats()
+    self.assertGreater(after["commit"], before["commit"])
+    bottles = lambda stats: sum(g["bottles"] for g in stats["vintage"])
+    self.assertEqual(bottles(after), bottles(before) + 1)
+    rebuilt = StatsCache(self.manager)
+    with Snapshot(self.manager) as snapshot:
+      self.assertEqual(rebuilt.Get(snapshot.commit), after)
+
+class DeltaSyncTest(unittest.TestCase):
+  def setUp(self):
+    self.manager = MakeManager()
+
+  def tearDown(self):
+    self.manager.Shutdown()
+
+  # Recovering from a lost wine gives the year a new parent and nothing else.
+  def testReparentedYear(self):
+    conn = self.manager._conn
+    year_id, wine_id = conn.execute(
+        "SELECT id, wine FROM years ORDER BY id LIMIT 1").fetchone()
+    conn.execute("UPDATE years SET wine=0 WHERE id=?", (year_id,))
+    conn.commit()
+    commit = self.manager.GetCommit()
+    year, = [y for y in self.manager.GetAll2(0)["years"]
+             if y["server_id"] == year_id]
+    self.manager.Set({"years": [
+      dict(year, wine_id=wine_id, local_id=1)
+    ]})
+    years = self.manager.GetAll2(commit, True)["years"]
+    self.assertEqual([(y["server_id"], y["wine_id"]) for y in years],
+                     [(year_id, wine_id)])
+
+if __name__ == "__main__":
+  unittest.main()
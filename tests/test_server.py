@@ -0,0 +1,71 @@
+import logging
+import unittest
+import unittest.mock
+
+from tests.helpers import Json, StartServer, StopServer
+from winedb import aioserver
+
+logging.getLogger("winedb").setLevel(logging.CRITICAL)
+
+class ServerTest(unittest.TestCase):
+  engine = "threads"
+
+  def setUp(self):
+    self.server, self.fetch = StartServer(self.engine)
+
+  def tearDown(self):
+    StopServer(self.server)
+
+  def testLongPollRejectsBadWait(self):
+    for wait in ("abc", "-1", "nan"):
+      status, _ = self.fetch(f"/api/get?last_commit=1&wait={wait}")
+      self.assertEqual(status, 400, wait)
+
+  def testLongPollTimesOut(self):
+    commit = self.server.manager.GetCommit()
+    status, _ = self.fetch(f"/api/get?last_commit={commit}&wait=0.1")
+    self.assertEqual(status, 200)
+
+  def testColumnsRejectsDelta(self):
+    commit = self.server.manager.GetCommit()
+    status, _ = self.fetch(
+        f"/api/get?last_commit={commit}&format=columns&delta=1&wait=30")
+    self.assertEqual(status, 400)
+    status, body = self.fetch("/api/get?last_commit=0&format=columns")
+    self.assertEqual(status, 200)
+    self.assertEqual(Json(body)["commit"], commit)
+    self.assertIn("keys", Json(body)["years"])
+
+  def testExportStreams(self):
+    status, body = self.fetch("/export")
+    self.assertEqual(status, 200)
+    expected = b"".join(
+        chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+        for chunk in self.server.manager.ExportCSV())
+    self.assertEqual(body, expected)
+
+  def testStockRejectsMalformedEntries(self):
+    for entries in ('"ab"', '[1]', '{"year_id": 1}', '[{"year_id": "x"}]'):
+      status, _ = self.fetch("/api/stock",
+                             f'{{"entries": {entries}}}'.encode("utf-8"),
+                             {"Content-Type": "application/json"})
+      self.assertEqual(status, 400, entries)
+
+class AsyncServerTest(ServerTest):
+  engine = "asyncio"
+
+  # Small pieces: every chunk goes through the event loop on its own.
+  def testExportStreamsInPieces(self):
+    with unittest.mock.patch.object(aioserver, "WRITE_BUFFER_BYTES", 16):
+      self.testExportStreams()
+      status, _ = self.fetch("/api/get?last_commit=0")
+      self.assertEqual(status, 200)
+
+  def testInternalError(self):
+    with unittest.mock.patch.object(
+        self.server.manager, "ExportCSV", side_effect=RuntimeError):
+      status, _ = self.fetch("/export")
+    self.assertEqual(status, 500)
+
+if __name__ == "__main__":
+  unittest.main()
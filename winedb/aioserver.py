@@ -0,0 +1,243 @@
+import asyncio
+import concurrent.futures
+import io
+import logging
+import threading
+import urllib
+
+from .assets import AssetCache
+from .manager import Manager
+from .metrics import Metrics
+from .responsecache import ResponseCache
+from .server import (KEEP_ALIVE_TIMEOUT, RESPONSE_CACHE_BYTES, ParseWait,
+                     WineHandler)
+
+logger = logging.getLogger(__name__)
+
+# Requests whose headers don't fit are refused.
+MAX_HEADER_BYTES = 64 * 1024
+
+INTERNAL_ERROR = (b"HTTP/1.1 500 Internal Server Error\r\n"
+                  b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+# Writes of a response are collected up to this size before being handed to
+# the event loop.
+WRITE_BUFFER_BYTES = 64 * 1024
+
+# The wfile of a StreamingWineHandler: passes what the handler writes on to
+# the connection's StreamWriter and waits for it to drain, so that large
+# responses (/export, sync pages) stream out with bounded memory.
+class LoopWriter:
+  def __init__(self, writer, loop):
+    self._writer = writer
+    self._loop = loop
+    self._buffer = bytearray()
+    self.sent = False  # Whether anything has gone out yet.
+
+  def write(self, data):
+    self._buffer += data
+    if len(self._buffer) >= WRITE_BUFFER_BYTES:
+      self.flush()
+    return len(data)
+
+  def flush(self):
+    if not self._buffer: return
+    data = bytes(self._buffer)
+    self._buffer.clear()
+    self.sent = True
+    asyncio.run_coroutine_threadsafe(self._Send(data), self._loop).result()
+
+  # Drops what hasn't been sent yet.
+  def Discard(self):
+    self._buffer.clear()
+
+  async def _Send(self, data):
+    if self._writer.is_closing():
+      raise ConnectionResetError("Connection closed")
+    self._writer.write(data)
+    await self._writer.drain()
+
+# A WineHandler for one request that has already been read. Runs on the
+# executor and writes its response through a LoopWriter.
+class StreamingWineHandler(WineHandler):
+  def __init__(self, raw, client_address, server, wfile):
+    self._server = server
+    self._basedir = server.basedir
+    self._origin = None
+    self.server = server
+    self.client_address = client_address
+    self.rfile = io.BytesIO(raw)
+    self.wfile = wfile
+    self.close_connection = True
+
+  # The event loop has already waited, without tying up a thread.
+  def _wait_for_change(self, client_knows_commit, timeout):
+    pass
+
+def _ContentLength(head):
+  for line in head.split(b"\r\n")[1:]:
+    name, _, value = line.partition(b":")
+    if name.strip().lower() == b"content-length":
+      return int(value.strip())
+  return 0
+
+# Returns (client commit, timeout) if |head| is an /api/get long poll.
+def _LongPoll(head):
+  request_line = head.split(b"\r\n", 1)[0].decode("latin-1")
+  parts = request_line.split()
+  if len(parts) != 3 or parts[0] != "GET": return None
+  parsed = urllib.parse.urlparse(parts[1])
+  if parsed.path != "/api/get": return None
+  query = urllib.parse.parse_qs(parsed.query)
+  if "wait" not in query or "page_token" in query: return None
+  if query.get("format") == ["columns"] and query.get("delta") == ["1"]:
+    return None  # Rejected right away.
+  try:
+    return int(query["last_commit"][0]), ParseWait(query["wait"][0])
+  except (KeyError, ValueError):
+    return None  # WineHandler sends the error.
+
+# Serves the same routes as WineServer, but on one asyncio event loop: idle
+# connections and pending long polls cost a coroutine instead of a thread.
+# Requests are handled by WineHandler on a small thread pool, so SQLite never
+# blocks the loop.
+class AsyncWineServer:
+  def __init__(self, port, db_file, basedir, manager_options=None,
+               metrics=False, keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+               response_cache_bytes=RESPONSE_CACHE_BYTES, workers=8):
+    self.port = port
+    self.manager = None
+    self.thread = None
+    self.db_file = db_file
+    self.manager_options = manager_options or {}
+    self.basedir = basedir
+    self.assets = AssetCache(basedir)
+    self.metrics = Metrics() if metrics else None
+    self.keep_alive_timeout = keep_alive_timeout
+    self.response_cache = (ResponseCache(response_cache_bytes)
+                           if response_cache_bytes > 0 else None)
+    self.server_address = None  # Known once listening.
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        workers, thread_name_prefix="winedb-db")
+    self._loop = None
+    self._stop = None
+    self._changed = None
+    self._writers = set()
+    self.started = threading.Event()
+    self.shutdown_done = threading.Event()
+
+  def Start(self):
+    self.thread = threading.Thread(target=self._Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _Run(self):
+    try:
+      asyncio.run(self._Main())
+    finally:
+      self.started.set()
+      self.shutdown_done.set()
+
+  async def _Main(self):
+    self._loop = asyncio.get_running_loop()
+    self._stop = asyncio.Event()
+    self._changed = asyncio.Event()
+    self.manager = Manager(self.db_file, metrics=self.metrics,
+                           **self.manager_options)
+    self.manager.AddChangeListener(self._OnCommit)
+    if self.response_cache is not None:
+      self.response_cache.Invalidate(self.manager.GetCommit())
+      self.manager.AddChangeListener(self.response_cache.Invalidate)
+    # IPv4 only, like WineServer; with port 0, binding IPv6 as well would
+    # pick a different port for it.
+    server = await asyncio.start_server(self._Serve, "0.0.0.0", self.port,
+                                        limit=MAX_HEADER_BYTES)
+    self.server_address = server.sockets[0].getsockname()
+    print(f"Server läuft auf Port {self.server_address[1]}")
+    self.started.set()
+    try:
+      await self._stop.wait()
+    finally:
+      server.close()
+      # Don't wait for pending long polls and idle connections.
+      for writer in list(self._writers):
+        writer.close()
+      self.manager.RemoveChangeListener(self._OnCommit)
+      # Handlers still writing need the loop to finish.
+      await asyncio.to_thread(self._executor.shutdown)
+      self.manager.Shutdown()
+
+  def Shutdown(self):
+    self.started.wait()
+    try:
+      self._loop.call_soon_threadsafe(self._stop.set)
+    except RuntimeError:
+      pass  # The loop has already finished.
+    self.shutdown_done.wait()
+
+  # Called on the committing thread.
+  def _OnCommit(self, commit):
+    try:
+      self._loop.call_soon_threadsafe(self._WakeUp)
+    except RuntimeError:
+      pass  # Shutting down.
+
+  def _WakeUp(self):
+    self._changed.set()
+    self._changed = asyncio.Event()
+
+  async def _WaitForChange(self, client_knows_commit, timeout):
+    deadline = self._loop.time() + timeout
+    while self.manager.GetCommit() == client_knows_commit:
+      remaining = deadline - self._loop.time()
+      if remaining <= 0: return
+      try:
+        await asyncio.wait_for(self._changed.wait(), remaining)
+      except asyncio.TimeoutError:
+        return
+
+  async def _Serve(self, reader, writer):
+    client_address = writer.get_extra_info("peername")
+    self._writers.add(writer)
+    try:
+      while True:
+        try:
+          head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                        self.keep_alive_timeout)
+          body = await reader.readexactly(_ContentLength(head))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError, ValueError):
+          return
+        long_poll = _LongPoll(head)
+        if long_poll is not None:
+          await self._WaitForChange(*long_poll)
+        close = await self._loop.run_in_executor(
+            self._executor, self._Handle, head + body, client_address, writer)
+        if close: return
+    except ConnectionError:
+      pass
+    finally:
+      self._writers.discard(writer)
+      writer.close()
+
+  # Runs on the executor. Returns whether to close the connection.
+  def _Handle(self, raw, client_address, writer):
+    wfile = LoopWriter(writer, self._loop)
+    handler = StreamingWineHandler(raw, client_address, self, wfile)
+    try:
+      handler.handle_one_request()
+      wfile.flush()
+      return handler.close_connection
+    except ConnectionError:
+      return True  # The client went away.
+    except Exception:
+      logger.exception("Error handling request from %s", client_address)
+    # Without a response started, the client can still be told.
+    if not wfile.sent:
+      wfile.Discard()
+      wfile.write(INTERNAL_ERROR)
+      try:
+        wfile.flush()
+      except ConnectionError:
+        pass
+    return True
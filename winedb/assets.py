@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+import os
+import threading
+
+# Brotli is optional; without it, we only offer gzip.
+try:
+  import brotli
+except ModuleNotFoundError:
+  brotli = None
+
+MIMETYPES = {
+  ".html": "text/html; charset=utf-8",
+  ".js": "text/javascript",
+  ".js.map": "application/json",
+  ".css": "text/css",
+  ".ts": "application/x-typescript",
+  ".ico": "image/x-icon",
+}
+
+# Compressing tiny files isn't worth the extra header bytes.
+MIN_COMPRESS_SIZE = 512
+
+def GetMimetype(path):
+  for suffix, mimetype in MIMETYPES.items():
+    if path.endswith(suffix): return mimetype
+  return None
+
+# Parses an Accept-Encoding header into the set of acceptable codings.
+def AcceptedEncodings(header):
+  result = set()
+  if not header: return result
+  for part in header.split(","):
+    fields = part.strip().split(";")
+    coding = fields[0].strip().lower()
+    q = 1.0
+    for param in fields[1:]:
+      name, _, value = param.strip().partition("=")
+      if name == "q":
+        try:
+          q = float(value)
+        except ValueError:
+          pass
+    if q > 0: result.add(coding)
+  return result
+
+# Checks an If-None-Match header against |etag|.
+def EtagMatches(header, etag):
+  if not header: return False
+  for candidate in header.split(","):
+    candidate = candidate.strip()
+    if candidate == "*": return True
+    if candidate.startswith("W/"): candidate = candidate[2:]
+    if candidate == etag: return True
+  return False
+
+class Asset:
+  def __init__(self, path, mimetype, mtime, data):
+    self.path = path
+    self.mimetype = mimetype
+    self.mtime = mtime
+    digest = hashlib.sha1(data).hexdigest()
+    # Each encoding is its own representation and needs its own strong ETag.
+    self.variants = {"identity": (data, f'"{digest}"')}
+    if mimetype == "image/x-icon" or len(data) < MIN_COMPRESS_SIZE: return
+    self.variants["gzip"] = (gzip.compress(data, 9), f'"{digest}-gz"')
+    if brotli is not None:
+      self.variants["br"] = (brotli.compress(data), f'"{digest}-br"')
+
+  # Returns (encoding, body, etag) for the best variant the client accepts.
+  def Select(self, accept_encoding):
+    accepted = AcceptedEncodings(accept_encoding)
+    for encoding in ("br", "gzip"):
+      if encoding in accepted and encoding in self.variants:
+        return (encoding,) + self.variants[encoding]
+    return ("identity",) + self.variants["identity"]
+
+# Static files under |basedir|, read once and kept in memory along with their
+# compressed variants. A file is reloaded when its mtime changes, e.g. after
+# an update.
+class AssetCache:
+  def __init__(self, basedir):
+    self._basedir = os.path.realpath(basedir)
+    self._assets = {}
+    self._lock = threading.Lock()
+
+  # Returns the Asset for the URL |path|, or None if there is no such file.
+  def Get(self, path):
+    mimetype = GetMimetype(path)
+    if mimetype is None: return None
+    filename = os.path.realpath(os.path.join(self._basedir, path.lstrip("/")))
+    if not filename.startswith(self._basedir + os.sep): return None
+    try:
+      mtime = os.stat(filename).st_mtime_ns
+    except OSError:
+      return None
+    asset = self._assets.get(filename)
+    if asset is not None and asset.mtime == mtime: return asset
+    with self._lock:
+      asset = self._assets.get(filename)
+      if asset is not None and asset.mtime == mtime: return asset
+      try:
+        with open(filename, "rb") as f:
+          data = f.read()
+      except OSError:
+        return None
+      asset = Asset(path, mimetype, mtime, data)
+      self._assets[filename] = asset
+      return asset
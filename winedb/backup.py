@@ -0,0 +1,120 @@
+import datetime
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Pages copied per step of an online backup; the source database is only
+# locked for the duration of one step.
+BACKUP_PAGES = 256
+BACKUP_STEP_SLEEP = 0.005
+
+# Copies |src| (an open connection) into a new database file |target|. The
+# copy is written under a temporary name first, so an interrupted backup
+# never looks like a finished one.
+def CopyDatabase(src, target, pages=-1, sleep=0):
+  tmp_name = f"{target}.tmp"
+  dst = sqlite3.connect(tmp_name)
+  try:
+    src.backup(dst, pages=pages, sleep=sleep)
+  finally:
+    dst.close()
+  os.replace(tmp_name, target)
+
+def _Compress(filename):
+  tmp_name = f"{filename}.gz.tmp"
+  with open(filename, "rb") as f, gzip.open(tmp_name, "wb") as out:
+    shutil.copyfileobj(f, out)
+  os.replace(tmp_name, f"{filename}.gz")
+  os.remove(filename)
+
+# Daily and monthly backups of a database file, made with SQLite's online
+# backup API on a background thread. Old copies are compressed and, beyond
+# the configured number per kind, deleted. 0 means keep all.
+class BackupManager:
+  def __init__(self, filename, connect, keep_daily=7, keep_monthly=12,
+               compress=True):
+    self._filename = filename
+    self._connect = connect
+    self._keep = {"daily": keep_daily, "monthly": keep_monthly}
+    self._compress = compress
+    base = re.escape(os.path.basename(filename))
+    self._patterns = {
+      "daily": re.compile(f"^{base}-(\\d{{4}}-\\d{{2}}-\\d{{2}})-backup"
+                          "(\\.gz)?$"),
+      "monthly": re.compile(f"^{base}-(\\d{{4}}-\\d{{2}})-backup(\\.gz)?$"),
+    }
+    self._jobs = queue.Queue()
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Monthly(self):
+    today = datetime.date.today().strftime("%Y-%m")
+    self._Schedule("monthly", f"{self._filename}-{today}-backup")
+
+  def Daily(self):
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    self._Schedule("daily", f"{self._filename}-{today}-backup")
+
+  def _Schedule(self, kind, backup_name):
+    if not os.path.exists(self._filename): return
+    if os.path.exists(backup_name): return
+    if os.path.exists(f"{backup_name}.gz"): return
+    self._jobs.put((kind, backup_name))
+
+  # Waits for scheduled backups to finish.
+  def Stop(self):
+    self._jobs.put(None)
+    self._thread.join()
+
+  def _Run(self):
+    while True:
+      job = self._jobs.get()
+      if job is None: return
+      kind, backup_name = job
+      try:
+        self._Backup(kind, backup_name)
+      except (OSError, sqlite3.Error):
+        logger.exception("Backup %s failed", backup_name)
+
+  def _Backup(self, kind, backup_name):
+    if os.path.exists(backup_name): return
+    src = self._connect()
+    try:
+      CopyDatabase(src, backup_name, BACKUP_PAGES, BACKUP_STEP_SLEEP)
+    finally:
+      src.close()
+    logger.info("Created backup %s", backup_name)
+    self._ApplyRetention(kind)
+
+  # Returns the backups of |kind|, newest first.
+  def _List(self, kind):
+    directory = os.path.dirname(self._filename) or "."
+    found = []
+    for name in os.listdir(directory):
+      match = self._patterns[kind].match(name)
+      if match is None: continue
+      found.append((match.group(1), os.path.join(directory, name)))
+    found.sort(reverse=True)
+    return [path for _, path in found]
+
+  def _ApplyRetention(self, kind):
+    backups = self._List(kind)
+    keep = self._keep[kind]
+    if keep > 0:
+      for path in backups[keep:]:
+        logger.info("Deleting old backup %s", path)
+        os.remove(path)
+      backups = backups[:keep]
+    if not self._compress: return
+    # The newest copy stays uncompressed, ready to be restored.
+    for path in backups[1:]:
+      if not path.endswith(".gz"):
+        _Compress(path)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the Manager entry points and the HTTP endpoints on a
+# synthetic cellar. Prints the results as JSON, for comparing commits:
+#   python3 -m winedb.benchmark --vineyards 100 --output before.json
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from .aioserver import AsyncWineServer
+from .manager import LOG_ROLLUPS, Manager
+from .server import WineServer
+from .stats import StatsCache
+
+GRAPES = ["Riesling", "Spätburgunder", "Lemberger", "Silvaner", "Merlot", ""]
+COUNTRIES = [("Deutschland", "Baden"), ("Deutschland", "Württemberg"),
+             ("Frankreich", "Elsass"), ("Italien", "Piemont")]
+
+# Generates a push payload (the shape of MakeFakeData()) with the given number
+# of rows per parent row. Wines, years and log entries refer to their parents
+# by local id, which matches the server id when pushed into an empty database.
+def MakeSyntheticData(vineyards, wines, years, log, seed=0):
+  rnd = random.Random(seed)
+  data = {"vineyards": [], "wines": [], "years": [], "log": []}
+  for v in range(vineyards):
+    country, region = rnd.choice(COUNTRIES)
+    data["vineyards"].append({
+      "name": f"Weingut {v}", "country": country, "region": region,
+      "address": "", "website": "", "comment": "",
+      "server_id": 0, "local_id": v + 1,
+    })
+    for _ in range(wines):
+      wine_id = len(data["wines"]) + 1
+      data["wines"].append({
+        "vineyard_id": v + 1, "name": f"Wein {wine_id}",
+        "grape": rnd.choice(GRAPES), "comment": "",
+        "server_id": 0, "local_id": wine_id,
+      })
+      for y in range(years):
+        year_id = len(data["years"]) + 1
+        data["years"].append({
+          "wine_id": wine_id, "year": 2000 + y, "count": rnd.randint(0, 12),
+          "stock": 0, "price": round(rnd.uniform(5, 40), 2),
+          "rating": rnd.randint(0, 5), "value": rnd.randint(0, 5),
+          "sweetness": rnd.randint(0, 5), "age": rnd.randint(0, 5),
+          "age_update": 0, "comment": "Kommentar " * rnd.randint(0, 5),
+          "location": f"Regal {rnd.randint(1, 20)}",
+          "server_id": 0, "local_id": year_id,
+        })
+        day = datetime.date(2020, 1, 1)
+        for l in range(log):
+          data["log"].append({
+            "year_id": year_id,
+            "date": (day + datetime.timedelta(days=l)).isoformat(),
+            "delta": rnd.choice([-2, -1, 1, 6]), "reason": rnd.randint(0, 3),
+            "comment": "", "server_id": 0, "local_id": len(data["log"]) + 1,
+          })
+  return data
+
+def Measure(function, repeat):
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    timings.append(time.perf_counter() - start)
+  return {
+    "runs": repeat,
+    "min": min(timings),
+    "median": statistics.median(timings),
+    "mean": statistics.mean(timings),
+  }
+
+def _Consume(iterable):
+  for _ in iterable: pass
+
+def _YearUpdates(data, count):
+  years = []
+  for i, y in enumerate(data["years"][:count]):
+    years.append(dict(y, server_id=i + 1, comment="geändert"))
+  return {"years": years}
+
+def _AllPages(manager, page_size):
+  page = manager.GetAll2Page(0, page_size)
+  while "next_page_token" in page:
+    page = manager.GetAll2Page(0, page_size, page["next_page_token"])
+
+def BenchmarkManager(manager, data, repeat):
+  commit = manager._committed
+  updates = _YearUpdates(data, 1000)
+  stock = [{"year_id": i + 1, "delta": 1} for i in range(1000)]
+  wine_ids = [w["local_id"] for w in data["wines"][:repeat]]
+  vineyard_ids = [v["local_id"] for v in data["vineyards"][:repeat]]
+  benchmarks = {
+    "GetAll2(full)": lambda: manager.GetAll2(0),
+    "GetAll2(incremental)": lambda: manager.GetAll2(commit),
+    "GetAll2(delta)": lambda: manager.GetAll2(commit, True),
+    "GetAll2Page(1000, all pages)": lambda: _AllPages(manager, 1000),
+    "Set(1000 years)": lambda: manager.Set(updates),
+    "GetAll(only_existing=0)": lambda: manager.GetAll("0"),
+    "GetAll(only_existing=1)": lambda: manager.GetAll("1"),
+    "GetSorted(price_desc)": lambda: manager.GetSorted(1, "price_desc"),
+    "GetSortedPage(price_desc, 50)": lambda: manager.GetSortedPage(
+        1, "price_desc", 50),
+    "Search(riesling)": lambda: manager.Search("riesling"),
+    "GetTotals": manager.GetTotals,
+    "GetStats(rebuild)": lambda: StatsCache(manager).Get(manager.GetCommit()),
+    "GetLog(100)": lambda: manager.GetLog(100),
+    "GetLogSeries(month, vineyard)": lambda: manager.GetLogSeries(
+        "month", by="vineyard"),
+    "ExportCSV": lambda: _Consume(manager.ExportCSV()),
+    "ApplyStockWine": lambda: manager.ApplyStockWine(
+        wine_ids[len(wine_ids) // 2]),
+    "ApplyStockVineyard": lambda: manager.ApplyStockVineyard(
+        vineyard_ids[len(vineyard_ids) // 2]),
+    "ApplyStockAll": manager.ApplyStockAll,
+    "SetStock(1000 entries)": lambda: manager.SetStock(stock),
+  }
+  results = {}
+  for name, function in benchmarks.items():
+    results[name] = Measure(function, repeat)
+  return results
+
+def BenchmarkHttp(db_file, basedir, data, repeat, engine="threads"):
+  if engine == "asyncio":
+    server = AsyncWineServer(0, db_file, basedir)
+    server.Start()
+    server.started.wait()
+  else:
+    server = WineServer(0, db_file, basedir)
+    server.Start()
+    while server.manager is None: time.sleep(0.01)
+  base = f"http://127.0.0.1:{server.server_address[1]}"
+  updates = json.dumps(_YearUpdates(data, 1000)).encode("utf-8")
+  def Get(path, headers=None):
+    request = urllib.request.Request(base + path, headers=headers or {})
+    return lambda: urllib.request.urlopen(request).read()
+  def Post(path, body, content_type):
+    def Send():
+      request = urllib.request.Request(base + path, data=body,
+                                       headers={"Content-Type": content_type})
+      urllib.request.urlopen(request).read()
+    return Send
+  form = urllib.parse.urlencode({"yearid": 1}).encode("utf-8")
+  stock = json.dumps({"entries": [{"year_id": i + 1, "delta": 1}
+                                  for i in range(1000)]}).encode("utf-8")
+  benchmarks = {
+    "GET /api/get?last_commit=0": Get("/api/get?last_commit=0"),
+    "GET /api/get?last_commit=0 (gzip)": Get(
+        "/api/get?last_commit=0", {"Accept-Encoding": "gzip"}),
+    "POST /api/set (1000 years)": Post("/api/set", updates,
+                                       "application/json"),
+    "GET /get_all": Get("/get_all?only_existing=1"),
+    "GET /get_sorted": Get("/get_sorted?only_existing=1&sortby=price_desc"),
+    "GET /get_totals": Get("/get_totals"),
+    "GET /export": Get("/export"),
+    "GET /js/ui.js": Get("/js/ui.js"),
+    "POST /add_stock": Post("/add_stock", form,
+                            "application/x-www-form-urlencoded"),
+    "POST /api/stock (1000 entries)": Post("/api/stock", stock,
+                                           "application/json"),
+  }
+  results = {}
+  try:
+    for name, function in benchmarks.items():
+      results[name] = Measure(function, repeat)
+  finally:
+    server.Shutdown()
+    if engine != "asyncio": server.server_close()
+  return results
+
+def _GitCommit(basedir):
+  try:
+    output = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                     cwd=basedir, stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return output.decode("utf-8").strip()
+
+def Main(argv):
+  parser = argparse.ArgumentParser(
+      description="Benchmarks winedb on a synthetic cellar.")
+  parser.add_argument("--vineyards", type=int, default=100)
+  parser.add_argument("--wines", type=int, default=8,
+                      help="wines per vineyard")
+  parser.add_argument("--years", type=int, default=5, help="years per wine")
+  parser.add_argument("--log", type=int, default=4,
+                      help="log entries per year")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--memory", action="store_true",
+                      help="use an in-memory database (skips HTTP benchmarks)")
+  parser.add_argument("--engine", choices=["threads", "asyncio"],
+                      default="threads",
+                      help="server engine for the HTTP benchmarks")
+  parser.add_argument("--output", help="write the JSON here, not to stdout")
+  args = parser.parse_args(argv)
+
+  basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  data = MakeSyntheticData(args.vineyards, args.wines, args.years, args.log,
+                           args.seed)
+  tmpdir = None
+  if args.memory:
+    db_file = ":memory:"
+  else:
+    tmpdir = tempfile.TemporaryDirectory()
+    db_file = os.path.join(tmpdir.name, "benchmark.sqlite3")
+  result = {
+    "parameters": vars(args),
+    "rows": {table: len(rows) for table, rows in data.items()},
+    "environment": {
+      "python": platform.python_version(),
+      "sqlite": sqlite3.sqlite_version,
+      "platform": platform.platform(),
+      "commit": _GitCommit(basedir),
+    },
+  }
+  # The Manager and the server report progress on stdout; keep that clean
+  # for the JSON output.
+  with contextlib.redirect_stdout(sys.stderr):
+    Run(args, data, db_file, basedir, result)
+  if tmpdir is not None: tmpdir.cleanup()
+
+  output = json.dumps(result, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+def Run(args, data, db_file, basedir, result):
+  manager = Manager(db_file)
+  if args.memory:
+    # The in-memory database starts out with MakeFakeData(); start over so
+    # that the local ids in |data| match the server ids. The tables kept by
+    # triggers are cleared as well, so nothing of the fake data is left.
+    with manager._write_lock:
+      for table in ("log", "years", "wines", "vineyards", "field_changes",
+                    "search", *LOG_ROLLUPS.values()):
+        manager._conn.execute(f"DELETE FROM {table}")
+      manager._RebuildTotals()
+      manager._conn.commit()
+  result["load"] = Measure(lambda: manager.Set(data), 1)
+  result["manager"] = BenchmarkManager(manager, data, args.repeat)
+  manager.Shutdown()
+  if not args.memory:
+    result["http"] = BenchmarkHttp(db_file, basedir, data, args.repeat,
+                                   args.engine)
+
+if __name__ == "__main__":
+  Main(sys.argv[1:])
@@ -94,6 +94,14 @@ class Window(qt.QMainWindow):
     cols_layout.addWidget(left_col_box)
     cols_layout.addWidget(right_col_box)
 
+    self.metrics = self.app.main.server.metrics
+    if self.metrics is not None:
+      self.metrics_label = qt.QLabel(self.metrics.Summary())
+      main_layout.addWidget(self.metrics_label)
+      self.metrics_timer = qtcore.QTimer(self)
+      self.metrics_timer.timeout.connect(self.update_metrics)
+      self.metrics_timer.start(5000)
+
     mainpart.setLayout(main_layout)
 
     icon_img = os.path.join(self.app.main.basedir, "favicon.ico")
@@ -102,6 +110,9 @@ class Window(qt.QMainWindow):
     trayicon = SystemTrayIcon(icon, self)
     trayicon.show()
 
+  def update_metrics(self):
+    self.metrics_label.setText(self.metrics.Summary())
+
   def open_button_clicked(self):
     webbrowser.open(self.app.getAddress())
 
@@ -1,9 +1,15 @@
 import configparser
+import logging
+import logging.handlers
 import os
+import queue
 import socket
 
+from .aioserver import AsyncWineServer
 from .server import WineServer
 
+SERVER_ENGINES = {"threads": WineServer, "asyncio": AsyncWineServer}
+
 class Main():
   def __init__(self):
     self.basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -11,6 +17,7 @@ class Main():
     self.config = configparser.ConfigParser()
     self.config.read(self.config_filename)
     self._InitSettings()
+    self._InitLogging()
     try:
       self.ip = socket.gethostbyname(socket.gethostname())
     except socket.gaierror:
@@ -29,6 +36,34 @@ class Main():
     define(Main.key_database_filename, 'wines.sqlite3')
     define(Main.key_port, '7887')
     define(Main.key_show_window_startup, 'true')
+    define(Main.key_journal_mode, 'wal')
+    define(Main.key_synchronous, 'normal')
+    define(Main.key_checkpoint_interval, '60')
+    define(Main.key_log_level, 'warning')
+    define(Main.key_backup_keep_daily, '7')
+    define(Main.key_backup_keep_monthly, '12')
+    define(Main.key_backup_compress, 'true')
+    define(Main.key_metrics, 'false')
+    define(Main.key_server_engine, 'threads')
+    define(Main.key_keep_alive_timeout, '30')
+    define(Main.key_response_cache_size, '32')
+
+  # Request threads only put log records into a queue; a background thread
+  # formats and writes them.
+  def _InitLogging(self):
+    level = self.confLogLevel()
+    if not isinstance(logging.getLevelName(level), int):
+      print(f"Unknown log level '{level}', using WARNING")
+      level = 'WARNING'
+    records = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    self.log_listener = logging.handlers.QueueListener(records, stream)
+    self.log_listener.start()
+    logger = logging.getLogger("winedb")
+    logger.setLevel(level)
+    logger.addHandler(logging.handlers.QueueHandler(records))
 
   def SaveAll(self):
     self._SaveSettings()
@@ -36,13 +71,22 @@ class Main():
 
   def SaveDatabase(self):
     self.server.Shutdown()
+    self.log_listener.stop()
 
   def Run(self, argv):
     if self.confDatabaseFilename() == ":memory:":
       db_file = self.confDatabaseFilename()
     else:
       db_file = os.path.join(self.basedir, self.confDatabaseFilename())
-    self.server = WineServer(self.confPort(), db_file, self.basedir)
+    server_class = SERVER_ENGINES.get(self.confServerEngine())
+    if server_class is None:
+      print(f"Unbekannte {Main.key_server_engine} "
+            f"'{self.confServerEngine()}', verwende 'threads'")
+      server_class = WineServer
+    self.server = server_class(
+        self.confPort(), db_file, self.basedir, self._ManagerOptions(),
+        self.confMetrics(), keep_alive_timeout=self.confKeepAliveTimeout(),
+        response_cache_bytes=self.confResponseCacheSize() * 1024 * 1024)
     self.server.Start()
     gui = '--headless' not in argv
     if gui:
@@ -56,7 +100,17 @@ class Main():
         self.server.thread.join()
       except KeyboardInterrupt:
         print("Shutting down")
-        self.server.Shutdown()
+        self.SaveDatabase()
+
+  def _ManagerOptions(self):
+    return {
+      "journal_mode": self.confJournalMode(),
+      "synchronous": self.confSynchronous(),
+      "checkpoint_interval": self.confCheckpointInterval(),
+      "backup_keep_daily": self.confBackupKeepDaily(),
+      "backup_keep_monthly": self.confBackupKeepMonthly(),
+      "backup_compress": self.confBackupCompress(),
+    }
 
   def confDatabaseFilename(self):
     return self._Settings()[Main.key_database_filename]
@@ -72,6 +126,44 @@ class Main():
     self._Settings()[Main.key_show_window_startup] = "true" if show else "false"
     self._SaveSettings()
 
+  def confJournalMode(self):
+    return self._Settings()[Main.key_journal_mode].lower()
+  def confSynchronous(self):
+    return self._Settings()[Main.key_synchronous].lower()
+  # Seconds between background WAL checkpoints; 0 disables them.
+  def confCheckpointInterval(self):
+    return self._Settings().getint(Main.key_checkpoint_interval)
+
+  # Number of daily/monthly backups to keep; 0 keeps all of them.
+  def confBackupKeepDaily(self):
+    return self._Settings().getint(Main.key_backup_keep_daily)
+  def confBackupKeepMonthly(self):
+    return self._Settings().getint(Main.key_backup_keep_monthly)
+  def confBackupCompress(self):
+    return self._Settings().getboolean(Main.key_backup_compress)
+
+  # One of Python's logging levels: debug, info, warning, error.
+  def confLogLevel(self):
+    return self._Settings()[Main.key_log_level].upper()
+
+  # Collect request and query statistics, served at /api/metrics.
+  def confMetrics(self):
+    return self._Settings().getboolean(Main.key_metrics)
+
+  # 'threads': one thread per connection. 'asyncio': one event loop, for
+  # many idle or long-polling clients.
+  def confServerEngine(self):
+    return self._Settings()[Main.key_server_engine].lower()
+
+  # Seconds an idle HTTP connection is kept open for the next request.
+  def confKeepAliveTimeout(self):
+    return self._Settings().getint(Main.key_keep_alive_timeout)
+
+  # Megabytes of encoded sync responses to keep for other clients asking for
+  # the same thing; 0 disables the cache.
+  def confResponseCacheSize(self):
+    return self._Settings().getint(Main.key_response_cache_size)
+
   def _Settings(self):
     return self.config[Main.key_settings]
   def _SaveSettings(self):
@@ -82,3 +174,14 @@ class Main():
   key_database_filename = 'DatabaseFilename'
   key_port = 'Port'
   key_show_window_startup = 'ShowWindowStartup'
+  key_journal_mode = 'JournalMode'
+  key_synchronous = 'Synchronous'
+  key_checkpoint_interval = 'CheckpointInterval'
+  key_log_level = 'LogLevel'
+  key_backup_keep_daily = 'BackupKeepDaily'
+  key_backup_keep_monthly = 'BackupKeepMonthly'
+  key_backup_compress = 'BackupCompress'
+  key_metrics = 'Metrics'
+  key_server_engine = 'ServerEngine'
+  key_keep_alive_timeout = 'KeepAliveTimeout'
+  key_response_cache_size = 'ResponseCacheSize'
@@ -1,11 +1,23 @@
+import base64
+import binascii
 import csv
 import datetime
 import io
+import json
+import logging
 import os
-import shutil
+import queue
 import sqlite3
+import threading
+import time
+import urllib.request
 import uuid
 
+from .backup import BackupManager, CopyDatabase
+from .stats import StatsCache
+
+logger = logging.getLogger(__name__)
+
 CREATE_VINEYARDS = """
 CREATE TABLE IF NOT EXISTS vineyards (
   id INTEGER PRIMARY KEY,
@@ -65,6 +77,331 @@ CREATE TABLE IF NOT EXISTS data (
   value TEXT
 )"""
 
+# Indexes for the lookups done on every sync: GetAll2 filters each table by
+# lastchange, and the _Set* functions look up pushed rows by their natural key.
+CREATE_INDEXES = [
+  "CREATE INDEX IF NOT EXISTS vineyards_lastchange ON vineyards(lastchange)",
+  "CREATE INDEX IF NOT EXISTS wines_lastchange ON wines(lastchange)",
+  "CREATE INDEX IF NOT EXISTS years_lastchange ON years(lastchange)",
+  "CREATE INDEX IF NOT EXISTS log_lastchange ON log(lastchange)",
+  "CREATE INDEX IF NOT EXISTS wines_vineyard_name ON wines(vineyard, name)",
+  "CREATE INDEX IF NOT EXISTS years_wine_year ON years(wine, year)",
+  "CREATE INDEX IF NOT EXISTS log_wine_date ON log(wine, date)",
+]
+
+# Bottle count and value (SUM(count * price)) of the years with count > 0,
+# per vineyard and for the whole cellar (vineyard TOTALS_ALL). Maintained by
+# the triggers below, so reading totals doesn't have to scan the years.
+TOTALS_ALL = -1
+CREATE_TOTALS = """
+CREATE TABLE IF NOT EXISTS vineyard_totals (
+  vineyard INTEGER PRIMARY KEY,
+  count INTEGER DEFAULT 0,
+  price REAL DEFAULT 0
+)"""
+
+# Adds (sign "+") or subtracts (sign "-") the year |row| to the totals.
+def _YearTotalsDelta(sign, row):
+  return f"""
+    INSERT INTO vineyard_totals(vineyard, count, price)
+      SELECT {TOTALS_ALL}, {sign}{row}.count, {sign}{row}.count * {row}.price
+      WHERE {row}.count > 0
+      UNION ALL
+      SELECT vineyard, {sign}{row}.count, {sign}{row}.count * {row}.price
+      FROM wines WHERE id = {row}.wine AND {row}.count > 0
+    ON CONFLICT(vineyard) DO UPDATE
+      SET count = count + excluded.count, price = price + excluded.price;"""
+
+# Adds or subtracts all years of wine |row| to the totals of its vineyard.
+def _WineTotalsDelta(sign, row):
+  return f"""
+    INSERT INTO vineyard_totals(vineyard, count, price)
+      SELECT {row}.vineyard, {sign}SUM(count), {sign}SUM(count * price)
+      FROM years WHERE wine = {row}.id AND count > 0
+      HAVING COUNT(*) > 0
+    ON CONFLICT(vineyard) DO UPDATE
+      SET count = count + excluded.count, price = price + excluded.price;"""
+
+CREATE_TOTALS_TRIGGERS = [
+  f"""CREATE TRIGGER IF NOT EXISTS years_totals_insert AFTER INSERT ON years
+  BEGIN {_YearTotalsDelta("+", "NEW")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS years_totals_delete AFTER DELETE ON years
+  BEGIN {_YearTotalsDelta("-", "OLD")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS years_totals_update
+  AFTER UPDATE OF count, price, wine ON years
+  BEGIN {_YearTotalsDelta("-", "OLD")} {_YearTotalsDelta("+", "NEW")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS wines_totals_insert AFTER INSERT ON wines
+  BEGIN {_WineTotalsDelta("+", "NEW")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS wines_totals_delete AFTER DELETE ON wines
+  BEGIN {_WineTotalsDelta("-", "OLD")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS wines_totals_update
+  AFTER UPDATE OF vineyard ON wines WHEN OLD.vineyard IS NOT NEW.vineyard
+  BEGIN {_WineTotalsDelta("-", "OLD")} {_WineTotalsDelta("+", "NEW")} END""",
+]
+
+# Recomputes vineyard_totals from scratch.
+COMPUTE_TOTALS = f"""
+  SELECT {TOTALS_ALL} AS vineyard, SUM(count) AS count,
+         SUM(count * price) AS price
+  FROM years WHERE count > 0
+  UNION ALL
+  SELECT wines.vineyard AS vineyard, SUM(years.count) AS count,
+         SUM(years.count * years.price) AS price
+  FROM years INNER JOIN wines ON years.wine = wines.id
+  WHERE years.count > 0
+  GROUP BY wines.vineyard"""
+
+# The rows /api/get sends, per table: the columns that identify a row (always
+# sent) and the other columns, each as (column, name in the payload).
+SYNC_COLUMNS = {
+  "vineyards": ([("id", "server_id")],
+                [(c, c) for c in ("name", "region", "country", "website",
+                                  "address", "comment")]),
+  "wines": ([("id", "server_id"), ("vineyard", "vineyard_id")],
+            [(c, c) for c in ("name", "grape", "comment")]),
+  "years": ([("id", "server_id"), ("wine", "wine_id"), ("year", "year")],
+            [(c, c) for c in ("count", "stock", "price", "rating", "value",
+                              "sweetness", "age", "age_update", "comment",
+                              "location")]),
+  "log": ([("id", "server_id"), ("wine", "year_id"), ("date", "date")],
+          [(c, c) for c in ("delta", "reason", "comment")]),
+}
+
+# The commit at which each column of each row last changed, so that delta
+# syncs can leave out the unchanged ones. Field "*" marks the commit at which
+# a row was created (or a deleted year revived): clients that are older than
+# that need all of it. Maintained by the triggers below; the key
+# "field_changes_since" in the data table says since when.
+CREATE_FIELD_CHANGES = [
+  """CREATE TABLE IF NOT EXISTS field_changes (
+    tbl TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    lastchange INTEGER,
+    PRIMARY KEY (tbl, row, field)
+  ) WITHOUT ROWID""",
+  """CREATE INDEX IF NOT EXISTS field_changes_lastchange
+  ON field_changes(tbl, lastchange)""",
+]
+
+_UPSERT_CHANGE = "ON CONFLICT DO UPDATE SET lastchange = excluded.lastchange;"
+
+# Identity columns other than the id are tracked as well: rows are re-parented
+# when recovering from lost wines and vineyards, and clients need to hear of
+# it. Delta syncs always send them.
+def _FieldChangesTriggers(table, identity, columns):
+  changed = " UNION ALL ".join(
+      f"SELECT '{c}' AS field WHERE OLD.{c} IS NOT NEW.{c}"
+      for c, _ in identity + columns if c != "id")
+  update = f"""
+    INSERT INTO field_changes(tbl, row, field, lastchange)
+      SELECT '{table}', NEW.id, field, NEW.lastchange FROM ({changed})
+      WHERE true
+    {_UPSERT_CHANGE}"""
+  if table == "years":
+    # Deleted years are tombstones: clients only need to hear that they are
+    # gone, so their other changes are dropped. Revived ones are sent whole.
+    update += f"""
+    DELETE FROM field_changes
+      WHERE NEW.count < 0 AND OLD.count >= 0
+        AND tbl = 'years' AND row = NEW.id AND field NOT IN ('count', '*');
+    INSERT INTO field_changes(tbl, row, field, lastchange)
+      SELECT 'years', NEW.id, '*', NEW.lastchange
+      WHERE NEW.count >= 0 AND OLD.count < 0
+    {_UPSERT_CHANGE}"""
+  return [
+    f"""CREATE TRIGGER IF NOT EXISTS {table}_field_changes_insert
+    AFTER INSERT ON {table} BEGIN
+    INSERT INTO field_changes(tbl, row, field, lastchange)
+      VALUES ('{table}', NEW.id, '*', NEW.lastchange)
+    {_UPSERT_CHANGE} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {table}_field_changes_update
+    AFTER UPDATE ON {table} BEGIN {update} END""",
+  ]
+
+CREATE_FIELD_CHANGES_TRIGGERS = [
+  trigger
+  for table, (identity, columns) in SYNC_COLUMNS.items()
+  for trigger in _FieldChangesTriggers(table, identity, columns)
+]
+
+# The columns GetSorted can sort by, each with an index.
+SORT_COLUMNS = ("count", "price", "rating", "year", "value", "sweetness", "age")
+CREATE_SORT_INDEXES = [
+  f"CREATE INDEX IF NOT EXISTS years_{column} ON years({column})"
+  for column in SORT_COLUMNS
+]
+SORTED_PAGE_MAX = 1000
+
+# Page tokens of GetSortedPage are [sort value, year id] as base64url JSON,
+# so that the value keeps its type: besides numbers, SQLite columns may hold
+# text or NULL.
+def _EncodeSortedPageToken(value, year_id):
+  data = json.dumps([value, year_id]).encode("utf-8")
+  return base64.urlsafe_b64encode(data).decode("ascii")
+
+def _DecodeSortedPageToken(token):
+  try:
+    value, year_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+  except (binascii.Error, UnicodeError, TypeError, ValueError):
+    raise ValueError(f"Invalid page token: {token}")
+  if (type(year_id) is not int or
+      not (value is None or type(value) in (int, float, str))):
+    raise ValueError(f"Invalid page token: {token}")
+  return value, year_id
+
+# The condition for the years after (|value|, |year_id|) in the order of
+# GetSorted. NULLs sort first in ascending order and last in descending
+# order, and row values with NULL don't compare.
+def _SortedAfter(column, direction, value, year_id):
+  column = f"years.{column}"
+  if direction == "asc":
+    if value is None:
+      return (f"(({column} IS NULL AND years.id > ?) OR "
+              f"{column} IS NOT NULL)", [year_id])
+    return f"({column}, years.id) > (?, ?)", [value, year_id]
+  if value is None:
+    return f"({column} IS NULL AND years.id < ?)", [year_id]
+  return (f"(({column}, years.id) < (?, ?) OR {column} IS NULL)",
+          [value, year_id])
+
+# Filters for GetSorted: name -> (condition, type of the value).
+SORT_FILTERS = {
+  "country": ("vineyards.country = ?", str),
+  "region": ("vineyards.region = ?", str),
+  "grape": ("wines.grape = ?", str),
+  "location": ("years.location = ?", str),
+  "year_min": ("years.year >= ?", int),
+  "year_max": ("years.year <= ?", int),
+  "price_min": ("years.price >= ?", float),
+  "price_max": ("years.price <= ?", float),
+}
+
+# Full-text index for /api/search: one document per year, holding the text
+# of the year, its wine and its vineyard, so that e.g. "riesling baden" finds
+# years whose grape is Riesling and whose vineyard is in Baden. The rowid is
+# the year's id. Maintained by the triggers below.
+SEARCH_COLUMNS = ("vineyard", "region", "country", "wine", "grape", "location",
+                  "comment", "wine_comment", "vineyard_comment")
+# bm25() weights, in the order of SEARCH_COLUMNS: names count most.
+SEARCH_WEIGHTS = (10, 4, 2, 10, 5, 3, 1, 1, 1)
+CREATE_SEARCH = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+  {", ".join(SEARCH_COLUMNS)},
+  tokenize = "unicode61 remove_diacritics 2",
+  prefix = "2 3"
+)"""
+
+def _SearchDocuments(condition):
+  return f"""
+    INSERT INTO search(rowid, {", ".join(SEARCH_COLUMNS)})
+      SELECT years.id, vineyards.name, vineyards.region, vineyards.country,
+             wines.name, wines.grape, years.location, years.comment,
+             wines.comment, vineyards.comment
+      FROM years
+      INNER JOIN wines ON years.wine = wines.id
+      INNER JOIN vineyards ON wines.vineyard = vineyards.id
+      WHERE {condition};"""
+
+def _Changed(columns):
+  return " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in columns)
+
+_WINE_YEARS = "SELECT id FROM years WHERE wine = {row}.id"
+_VINEYARD_YEARS = """SELECT years.id FROM years INNER JOIN wines
+  ON years.wine = wines.id WHERE wines.vineyard = {row}.id"""
+
+CREATE_SEARCH_TRIGGERS = [
+  f"""CREATE TRIGGER IF NOT EXISTS years_search_insert AFTER INSERT ON years
+  BEGIN {_SearchDocuments("years.id = NEW.id")} END""",
+  """CREATE TRIGGER IF NOT EXISTS years_search_delete AFTER DELETE ON years
+  BEGIN DELETE FROM search WHERE rowid = OLD.id; END""",
+  f"""CREATE TRIGGER IF NOT EXISTS years_search_update AFTER UPDATE ON years
+  WHEN {_Changed(("wine", "location", "comment"))} BEGIN
+    DELETE FROM search WHERE rowid = OLD.id;
+    {_SearchDocuments("years.id = NEW.id")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS wines_search_delete AFTER DELETE ON wines
+  BEGIN
+    DELETE FROM search WHERE rowid IN ({_WINE_YEARS.format(row="OLD")}); END""",
+  f"""CREATE TRIGGER IF NOT EXISTS wines_search_update AFTER UPDATE ON wines
+  WHEN {_Changed(("vineyard", "name", "grape", "comment"))} BEGIN
+    DELETE FROM search WHERE rowid IN ({_WINE_YEARS.format(row="OLD")});
+    {_SearchDocuments("years.wine = NEW.id")} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS vineyards_search_update
+  AFTER UPDATE ON vineyards
+  WHEN {_Changed(("name", "region", "country", "comment"))} BEGIN
+    DELETE FROM search WHERE rowid IN ({_VINEYARD_YEARS.format(row="OLD")});
+    {_SearchDocuments("wines.vineyard = NEW.id")} END""",
+]
+
+# Turns what the user typed into an FTS5 query: every word must match as
+# the start of a word.
+def _SearchQuery(text):
+  return " ".join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+# Bottles added (positive deltas) and removed (negative deltas) per day and
+# per month, wine and reason, for GetLogSeries. Maintained by the triggers
+# below; rows can drop to zero when log entries change, and stay.
+LOG_ROLLUPS = {"day": "log_daily", "month": "log_monthly"}
+CREATE_LOG_ROLLUPS = [
+  f"""CREATE TABLE IF NOT EXISTS {table} (
+    period TEXT NOT NULL,
+    wine INTEGER NOT NULL,
+    reason INTEGER NOT NULL,
+    added INTEGER DEFAULT 0,
+    removed INTEGER DEFAULT 0,
+    PRIMARY KEY (period, wine, reason)
+  ) WITHOUT ROWID"""
+  for table in LOG_ROLLUPS.values()
+]
+
+# Adds (sign "+") or subtracts (sign "-") the log entries from |select|, which
+# has the columns date, wine (the wine, not the year), reason and delta.
+def _LogRollupsDelta(sign, select):
+  statements = []
+  for table, period in (("log_daily", "date"),
+                        ("log_monthly", "substr(date, 1, 7)")):
+    statements.append(f"""
+    INSERT INTO {table}(period, wine, reason, added, removed)
+      SELECT {period}, wine, reason, {sign}MAX(delta, 0), {sign}MAX(-delta, 0)
+      FROM ({select}) WHERE true
+    ON CONFLICT DO UPDATE SET added = added + excluded.added,
+                              removed = removed + excluded.removed;""")
+  return statements
+
+def _LogEntry(row):
+  return f"""SELECT {row}.date AS date, years.wine AS wine,
+    {row}.reason AS reason, {row}.delta AS delta
+    FROM years WHERE years.id = {row}.wine"""
+
+# All log entries of year |row|, attributed to its wine.
+def _YearLogEntries(row):
+  return f"""SELECT date, {row}.wine AS wine, reason, delta
+    FROM log WHERE log.wine = {row}.id"""
+
+CREATE_LOG_ROLLUPS_TRIGGERS = [
+  f"""CREATE TRIGGER IF NOT EXISTS log_rollups_insert AFTER INSERT ON log
+  BEGIN {"".join(_LogRollupsDelta("+", _LogEntry("NEW")))} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS log_rollups_delete AFTER DELETE ON log
+  BEGIN {"".join(_LogRollupsDelta("-", _LogEntry("OLD")))} END""",
+  f"""CREATE TRIGGER IF NOT EXISTS log_rollups_update AFTER UPDATE ON log
+  WHEN {_Changed(("date", "wine", "reason", "delta"))} BEGIN
+    {"".join(_LogRollupsDelta("-", _LogEntry("OLD")))}
+    {"".join(_LogRollupsDelta("+", _LogEntry("NEW")))} END""",
+  # Years are re-parented when recovering from lost wines.
+  f"""CREATE TRIGGER IF NOT EXISTS years_log_rollups_update
+  AFTER UPDATE OF wine ON years WHEN OLD.wine IS NOT NEW.wine BEGIN
+    {"".join(_LogRollupsDelta("-", _YearLogEntries("OLD")))}
+    {"".join(_LogRollupsDelta("+", _YearLogEntries("NEW")))} END""",
+]
+
+# Groupings for GetLogSeries: name -> SQL expression over the rollups.
+LOG_SERIES_KEYS = {
+  "total": "NULL",
+  "wine": "rollups.wine",
+  "vineyard": "wines.vineyard",
+  "reason": "rollups.reason",
+}
+
 KNOWN_GRAPES = [
   "Bacchus",
   "Chardonnay",
@@ -97,18 +434,106 @@ GRAPE_GUESSES = {
   "Weißer Burgunder": "Weißburgunder",
 }
 
+# Write scope. Writes are serialized: the scope holds the write lock, so
+# |_lastchange| is incremented and committed by one thread at a time.
 class Update:
   def __init__(self, manager):
     self.manager = manager
 
   def __enter__(self):
+    self.manager._write_lock.acquire()
     self.manager._lastchange += 1
     self.manager._has_update_scope = True
     return self
 
   def __exit__(self, *args):
-    self.manager._conn.commit()
-    self.manager._has_update_scope = False
+    try:
+      self.manager._conn.commit()
+      self.manager._committed = self.manager._lastchange
+      self.manager._changed.notify_all()
+      for listener in self.manager._change_listeners:
+        listener(self.manager._committed)
+    finally:
+      self.manager._has_update_scope = False
+      self.manager._write_lock.release()
+
+# Read scope that sees one consistent state of the database. |commit| is
+# read before the transaction starts, so the data is at least as new as it.
+class Snapshot:
+  def __init__(self, manager):
+    self.manager = manager
+    self.commit = 0
+
+  def __enter__(self):
+    self.commit = self.manager._committed
+    self.conn = self.manager._ReadConnection()
+    if self.conn is not self.manager._conn:
+      self.conn.execute("BEGIN")
+    return self
+
+  def __exit__(self, *args):
+    if self.conn is not self.manager._conn:
+      self.conn.commit()
+
+# Periodically copies the write-ahead log back into the database file, so
+# that commits don't have to. Uses its own connection and never blocks
+# readers or the writer (PASSIVE mode).
+class Checkpointer:
+  def __init__(self, uri, interval):
+    self._uri = uri
+    self._interval = interval
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Run(self):
+    conn = sqlite3.connect(self._uri, uri=True)
+    try:
+      while not self._stop.wait(self._interval):
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    finally:
+      conn.close()
+
+  def Stop(self):
+    self._stop.set()
+    self._thread.join()
+
+# Read-only connections, handed out one per thread. A thread keeps its
+# connection until it calls Release(), typically at the end of a request.
+class ConnectionPool:
+  def __init__(self, connect, size):
+    self._connect = connect
+    self._idle = queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(size)
+    self._local = threading.local()
+
+  def Get(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      self._slots.acquire()
+      try:
+        conn = self._idle.get_nowait()
+      except queue.Empty:
+        conn = self._connect()
+      self._local.conn = conn
+    return conn
+
+  def Release(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is None: return
+    self._local.conn = None
+    if conn.in_transaction:
+      conn.rollback()
+    self._idle.put(conn)
+    self._slots.release()
+
+  def Close(self):
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        return
 
 def MakeFakeData():
   data = {"vineyards": [], "wines": [], "years": [], "log": []}
@@ -185,17 +610,204 @@ def MakeFakeData():
 
   return data
 
+# Largest number of ids or keys per lookup query in a batch upsert, well
+# below SQLite's limit on query parameters.
+BATCH_SIZE = 400
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Natural key columns with TEXT affinity; all others are INTEGER.
+TEXT_KEY_COLUMNS = ("name", "date")
+
+def _IntegerAffinity(value):
+  if isinstance(value, str):
+    try:
+      return int(value)
+    except ValueError:
+      pass
+    try:
+      value = float(value)
+    except ValueError:
+      return value
+  if isinstance(value, float) and value.is_integer():
+    return int(value)
+  return value
+
+def _TextAffinity(value):
+  if isinstance(value, (int, float)) and not isinstance(value, bool):
+    return str(value)
+  return value
+
+# Ids and natural keys of the rows a batch upsert has seen, see
+# Manager._FindRows(). The batch records its own inserts and updates here, so
+# that later rows in the same batch find them just like a SELECT would.
+class KnownRows:
+  def __init__(self, columns):
+    self._text = [column in TEXT_KEY_COLUMNS for column in columns]
+    self._keys = {}  # id -> key
+    self._ids = {}  # key -> ids
+
+  # Converts |key| the way SQLite does when storing or comparing it.
+  def Normalize(self, key):
+    return tuple(_TextAffinity(v) if text else _IntegerAffinity(v)
+                 for v, text in zip(key, self._text))
+
+  def Add(self, row_id, key):
+    key = self.Normalize(key)
+    old = self._keys.get(row_id)
+    if old is not None:
+      self._ids[old].discard(row_id)
+    self._keys[row_id] = key
+    self._ids.setdefault(key, set()).add(row_id)
+
+  def Get(self, row_id):
+    return self._keys[row_id]
+
+  # Like "SELECT id ... WHERE <key matches>", which returns the lowest id.
+  def Find(self, key):
+    key = self.Normalize(key)
+    if None in key: return None
+    ids = self._ids.get(key)
+    return min(ids) if ids else None
+
+  # Returns the id of the existing row that a pushed row refers to, or None.
+  def Resolve(self, server_id, key):
+    if not server_id: return self.Find(key)
+    server_id = _IntegerAffinity(server_id)
+    return server_id if server_id in self._keys else None
+
+# Collects a batch's INSERTs and UPDATEs, and runs each sequence of identical
+# statements with one executemany(). The order of all writes is preserved.
+class BatchStatements:
+  def __init__(self, manager):
+    self._manager = manager
+    self._stmt = None
+    self._args = []
+
+  def Add(self, stmt, args):
+    if stmt != self._stmt:
+      self.Flush()
+      self._stmt = stmt
+    self._args.append(args)
+
+  def Flush(self):
+    if self._args:
+      self._manager.ExecuteMany(self._stmt, self._args)
+    self._stmt = None
+    self._args = []
+
+# Wraps a cursor to time its statement. Most of a query's time is spent
+# stepping through its rows, so the time spent fetching counts too; the
+# statement is observed once its rows are exhausted, or when the cursor is
+# dropped or closed before that.
+class TimedCursor:
+  def __init__(self, cursor, stmt, metrics, seconds):
+    self._cursor = cursor
+    self._stmt = stmt
+    self._metrics = metrics
+    self._seconds = seconds
+    self._observed = False
+    if cursor.description is None:
+      self._Observe()  # No rows to fetch.
+
+  def _Observe(self):
+    if not self._observed:
+      self._observed = True
+      self._metrics.ObserveStatement(self._stmt, self._seconds)
+
+  def _Fetch(self, fetch, *args):
+    start = time.perf_counter()
+    try:
+      return fetch(*args)
+    finally:
+      self._seconds += time.perf_counter() - start
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    row = self.fetchone()
+    if row is None: raise StopIteration
+    return row
+
+  def fetchone(self):
+    row = self._Fetch(self._cursor.fetchone)
+    if row is None: self._Observe()
+    return row
+
+  def fetchmany(self, size=None):
+    if size is None: size = self._cursor.arraysize
+    rows = self._Fetch(self._cursor.fetchmany, size)
+    if len(rows) < size: self._Observe()
+    return rows
+
+  def fetchall(self):
+    rows = self._Fetch(self._cursor.fetchall)
+    self._Observe()
+    return rows
+
+  def close(self):
+    self._Observe()
+    self._cursor.close()
+
+  def __getattr__(self, name):
+    return getattr(self._cursor, name)
+
+  def __del__(self):
+    self._Observe()
+
+# Upper bound for the rows in one page of GetAll2Page.
+SYNC_PAGE_MAX = 5000
+
+# Page tokens are "<client commit>.<commit>.<table index>.<last id>".
+def _EncodePageToken(client_knows_commit, commit, table_index, after):
+  return f"{client_knows_commit}.{commit}.{table_index}.{after}"
+
+def _DecodePageToken(token):
+  parts = [int(part) for part in token.split(".")]
+  if len(parts) != 4 or not 0 <= parts[2] < len(SYNC_COLUMNS):
+    raise ValueError(f"Invalid page token: {token}")
+  return parts
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "wal")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+
 class Manager:
-  def __init__(self, filename):
+  def __init__(self, filename, read_connections=8, journal_mode="wal",
+               synchronous="normal", checkpoint_interval=60,
+               backup_keep_daily=7, backup_keep_monthly=12,
+               backup_compress=True, metrics=None):
     self._filename = filename
+    self._metrics = metrics
+    if filename == ":memory:":
+      # Readers can only see an in-memory database through a shared cache.
+      self._uri = f"file:winedb-{uuid.uuid4()}?mode=memory&cache=shared"
+      self._backups = None
+    else:
+      path = urllib.request.pathname2url(os.path.abspath(filename))
+      self._uri = f"file:{path}"
+      self._backups = BackupManager(filename, self._ConnectReader,
+                                    backup_keep_daily, backup_keep_monthly,
+                                    backup_compress)
     self._MonthlyDatabaseBackup()
-    conn = sqlite3.connect(filename)
+    # The writer connection is shared by all threads, guarded by the lock.
+    conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
     self._conn = conn
     conn.row_factory = sqlite3.Row
+    self._write_lock = threading.RLock()
+    # Signalled whenever an Update scope commits.
+    self._changed = threading.Condition(self._write_lock)
+    self._change_listeners = []
+    self._stats = StatsCache(self)
+    self._shutting_down = False
+    self._local = threading.local()
+    self._readers = ConnectionPool(self._ConnectReader, read_connections)
+    self._checkpointer = None
+    self._ConfigureJournal(journal_mode, synchronous, checkpoint_interval)
     self.ApplyDatabaseUpdates()
     self.SetUUID()
     self._lastchange = self.GetLastChange()
-    self._has_update_scope = False
+    self._committed = self._lastchange
     # TODO: vacuum?
     if filename == ":memory:":
       print("Populating in-memory database with fake data...")
@@ -206,34 +818,81 @@ class Manager:
 
   def Shutdown(self):
     print("Datenbank wird gespeichert")
-    self._conn.commit()
-    self._conn.close()
+    if self._checkpointer is not None:
+      self._checkpointer.Stop()
+    if self._backups is not None:
+      self._backups.Stop()
+    with self._write_lock:
+      self._shutting_down = True
+      self._changed.notify_all()
+      self._conn.commit()
+      self._readers.Close()
+      self._conn.close()
     print("Datenbank erfolgreich gespeichert")
 
+  # In WAL mode, writers don't block readers and commits only append to the
+  # log; with synchronous=normal they also don't wait for an fsync.
+  def _ConfigureJournal(self, journal_mode, synchronous, checkpoint_interval):
+    if self._filename == ":memory:": return
+    if journal_mode not in JOURNAL_MODES:
+      print(f"Unknown journal mode '{journal_mode}', using 'wal'")
+      journal_mode = "wal"
+    if synchronous not in SYNCHRONOUS_LEVELS:
+      print(f"Unknown synchronous level '{synchronous}', using 'normal'")
+      synchronous = "normal"
+    self._conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    self._conn.execute(f"PRAGMA synchronous = {synchronous}")
+    if journal_mode == "wal" and checkpoint_interval > 0:
+      # Checkpoints happen in the background instead of during commits.
+      self._conn.execute("PRAGMA wal_autocheckpoint = 0")
+      self._checkpointer = Checkpointer(self._uri, checkpoint_interval)
+
+  def _ConnectReader(self):
+    if self._filename == ":memory:":
+      conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+      # Shared-cache readers would otherwise block on the writer's table locks.
+      conn.execute("PRAGMA read_uncommitted = 1")
+    else:
+      conn = sqlite3.connect(f"{self._uri}?mode=ro", uri=True,
+                             check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+  # Thread-local, so that only the thread holding the write lock uses the
+  # writer connection for its reads.
+  @property
+  def _has_update_scope(self):
+    return getattr(self._local, "has_update_scope", False)
+  @_has_update_scope.setter
+  def _has_update_scope(self, value):
+    self._local.has_update_scope = value
+
+  def _ReadConnection(self):
+    if self._has_update_scope: return self._conn
+    return self._readers.Get()
+
+  # Returns the calling thread's read connection to the pool.
+  def ReleaseConnection(self):
+    self._readers.Release()
+
   # Backup strategy: if no backup has been created yet in the current calendar
-  # month, do that now.
+  # month, do that now. Runs in the background, see BackupManager.
   def _MonthlyDatabaseBackup(self):
-    if self._filename == ":memory:": return
-    if not os.path.exists(self._filename): return
-    today = datetime.date.today().strftime("%Y-%m")
-    backup_name = f"{self._filename}-{today}-backup"
-    if os.path.exists(backup_name): return
-    shutil.copyfile(self._filename, backup_name)
+    if self._backups is None: return
+    self._backups.Monthly()
 
   # Same as above, but for the current day. Triggered on demand, e.g. when
   # applying stock-taking mode end results.
   def _ExtraBackup(self):
-    if self._filename == ":memory:": return
-    if not os.path.exists(self._filename): return
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    backup_name = f"{self._filename}-{today}-backup"
-    if os.path.exists(backup_name): return
-    shutil.copyfile(self._filename, backup_name)
+    if self._backups is None: return
+    self._backups.Daily()
 
+  # Synchronous, because the schema update must wait for it.
   def _BackupDatabase(self, version):
     if self._filename == ":memory:": return
     backup_name = f"{self._filename}-database-version-{version}-autobackup"
-    shutil.copyfile(self._filename, backup_name)
+    CopyDatabase(self._conn, backup_name)
 
   def ApplyDatabaseUpdates(self):
     version = self._conn.execute("PRAGMA user_version").fetchone()[0]
@@ -246,14 +905,20 @@ class Manager:
       if existing != 5:
         print("Creating database tables...")
         # Creating tables at the latest version.
-        c.execute("PRAGMA user_version = 6")
+        c.execute("PRAGMA user_version = 13")
         c.execute(CREATE_VINEYARDS)
         c.execute(CREATE_WINES)
         c.execute(CREATE_YEARS)
         c.execute(CREATE_LOG)
         c.execute(CREATE_DATA)
+        for index in CREATE_INDEXES + CREATE_SORT_INDEXES:
+          c.execute(index)
+        self._CreateTotals()
+        self._CreateFieldChanges(0)
+        self._CreateSearch()
+        self._CreateLogRollups()
         self._conn.commit()
-        version = 6
+        version = 13
       else:
         print("Updating database version 0->1...")
         self._BackupDatabase(version)
@@ -302,9 +967,138 @@ class Manager:
       self._conn.execute("PRAGMA user_version = 6")
       self._conn.commit()
       version = 6
+    if version < 7:
+      print("Updating database version 6->7...")
+      self._BackupDatabase(version)
+      for index in CREATE_INDEXES:
+        self._conn.execute(index)
+      self._conn.execute("PRAGMA user_version = 7")
+      self._conn.commit()
+      version = 7
+    if version < 8:
+      print("Updating database version 7->8...")
+      self._BackupDatabase(version)
+      self._CreateTotals()
+      self._conn.execute("PRAGMA user_version = 8")
+      self._conn.commit()
+      version = 8
+    if version < 9:
+      print("Updating database version 8->9...")
+      self._BackupDatabase(version)
+      # Changes before now weren't tracked.
+      self._CreateFieldChanges(self.GetLastChange())
+      self._conn.execute("PRAGMA user_version = 9")
+      self._conn.commit()
+      version = 9
+    if version < 10:
+      print("Updating database version 9->10...")
+      self._BackupDatabase(version)
+      self._CreateSearch()
+      self._conn.execute("PRAGMA user_version = 10")
+      self._conn.commit()
+      version = 10
+    if version < 11:
+      print("Updating database version 10->11...")
+      self._BackupDatabase(version)
+      for index in CREATE_SORT_INDEXES:
+        self._conn.execute(index)
+      self._conn.execute("PRAGMA user_version = 11")
+      self._conn.commit()
+      version = 11
+    if version < 12:
+      print("Updating database version 11->12...")
+      self._BackupDatabase(version)
+      self._CreateLogRollups()
+      self._conn.execute("PRAGMA user_version = 12")
+      self._conn.commit()
+      version = 12
+    if version < 13:
+      print("Updating database version 12->13...")
+      self._BackupDatabase(version)
+      for table in SYNC_COLUMNS:
+        self._conn.execute(
+            f"DROP TRIGGER IF EXISTS {table}_field_changes_update")
+      # Re-parented rows weren't tracked so far; clients that may have missed
+      # one get a full sync.
+      self._CreateFieldChanges(self.GetLastChange())
+      self._conn.execute("PRAGMA user_version = 13")
+      self._conn.commit()
+      version = 13
     # When adding new database versions, don't forget to update the table
     # creation code at the top of this function!
 
+  def _CreateTotals(self):
+    self._conn.execute(CREATE_TOTALS)
+    for trigger in CREATE_TOTALS_TRIGGERS:
+      self._conn.execute(trigger)
+    self._RebuildTotals()
+
+  def _CreateFieldChanges(self, since):
+    for stmt in CREATE_FIELD_CHANGES + CREATE_FIELD_CHANGES_TRIGGERS:
+      self._conn.execute(stmt)
+    self._conn.execute(
+        "INSERT OR REPLACE INTO data(key, value) VALUES (?, ?)",
+        ("field_changes_since", str(since)))
+
+  def _CreateSearch(self):
+    self._conn.execute(CREATE_SEARCH)
+    for trigger in CREATE_SEARCH_TRIGGERS:
+      self._conn.execute(trigger)
+    self._conn.execute("DELETE FROM search")
+    self._conn.execute(_SearchDocuments("true"))
+
+  def _CreateLogRollups(self):
+    for stmt in CREATE_LOG_ROLLUPS + CREATE_LOG_ROLLUPS_TRIGGERS:
+      self._conn.execute(stmt)
+    for table in LOG_ROLLUPS.values():
+      self._conn.execute(f"DELETE FROM {table}")
+    for stmt in _LogRollupsDelta("+", """
+        SELECT log.date AS date, years.wine AS wine, log.reason AS reason,
+               log.delta AS delta
+        FROM log INNER JOIN years ON log.wine = years.id"""):
+      self._conn.execute(stmt)
+
+  # Callers must hold the write lock (or be initializing) and commit.
+  def _RebuildTotals(self):
+    self._conn.execute("DELETE FROM vineyard_totals")
+    self._conn.execute(f"""
+        INSERT INTO vineyard_totals(vineyard, count, price)
+        SELECT vineyard, count, price FROM ({COMPUTE_TOTALS})
+        WHERE count IS NOT NULL""")
+
+  def RebuildTotals(self):
+    with self._write_lock:
+      self._RebuildTotals()
+      self._conn.commit()
+
+  # Returns the vineyards whose maintained totals don't match the years.
+  def VerifyTotals(self):
+    expected = {}
+    for row in self.Execute(COMPUTE_TOTALS):
+      if row["count"] is None: continue
+      expected[row["vineyard"]] = (row["count"], row["price"])
+    actual = {}
+    for row in self.Execute("SELECT * FROM vineyard_totals WHERE count != 0"):
+      actual[row["vineyard"]] = (row["count"], row["price"])
+    mismatches = []
+    for vineyard in sorted(expected.keys() | actual.keys()):
+      count, price = expected.get(vineyard, (0, 0))
+      actual_count, actual_price = actual.get(vineyard, (0, 0))
+      # Prices are floats; allow for rounding differences of the sums.
+      if count != actual_count or abs(price - actual_price) > 1e-6:
+        mismatches.append({"vineyard": vineyard,
+                           "expected": {"count": count, "price": price},
+                           "actual": {"count": actual_count,
+                                      "price": actual_price}})
+    return mismatches
+
+  def _GetTotals(self, vineyard):
+    r = self.Execute("SELECT count, price FROM vineyard_totals WHERE vineyard=?",
+                     (vineyard,)).fetchone()
+    # Like SUM() over no rows.
+    if r is None or r["count"] == 0: return None, None
+    return r["count"], r["price"]
+
   def _GetLastChange(self, table):
     c = self._conn.execute(f"SELECT MAX(lastchange) FROM {table}")
     maybe = c.fetchone()[0]
@@ -334,229 +1128,328 @@ class Manager:
     if (stmt.startswith("UPDATE") or stmt.startswith('INSERT')):
       assert self._has_update_scope
       assert 'lastchange' in stmt
+    conn = self._ReadConnection()
+    if self._metrics is not None:
+      return self._TimedExecute(conn, stmt, args)
     if args is None:
-      return self._conn.execute(stmt)
-    return self._conn.execute(stmt, args)
+      return conn.execute(stmt)
+    return conn.execute(stmt, args)
+
+  def ExecuteMany(self, stmt, args):
+    assert self._has_update_scope
+    assert 'lastchange' in stmt
+    if self._metrics is None:
+      return self._conn.executemany(stmt, args)
+    start = time.perf_counter()
+    cursor = self._conn.executemany(stmt, args)
+    self._metrics.ObserveStatement(stmt, time.perf_counter() - start)
+    return cursor
+
+  def _TimedExecute(self, conn, stmt, args):
+    start = time.perf_counter()
+    cursor = conn.execute(stmt, () if args is None else args)
+    return TimedCursor(cursor, stmt, self._metrics,
+                       time.perf_counter() - start)
+
+  # Gauges for /api/metrics. Python's sqlite3 module has no access to the
+  # page cache hit counters, so these describe the size of the database and
+  # the cache instead.
+  def GetStorageStats(self):
+    stats = {}
+    for pragma in ("page_count", "page_size", "freelist_count", "cache_size"):
+      stats[pragma] = self.Execute(f"PRAGMA {pragma}").fetchone()[0]
+    if self._filename != ":memory:":
+      try:
+        stats["wal_bytes"] = os.path.getsize(f"{self._filename}-wal")
+      except OSError:
+        stats["wal_bytes"] = 0
+    return stats
 
   ################# v2 FUNCTIONALITY ######################
 
-  def GetAll2(self, client_knows_commit):
-    vineyards = []
-    cursor = self.Execute("SELECT * FROM vineyards WHERE lastchange>?",
-                          (client_knows_commit,))
-    for row in cursor:
-      vineyards.append({
-          "server_id": row["id"],
-          "name": row["name"],
-          "region": row["region"],
-          "country": row["country"],
-          "website": row["website"],
-          "address": row["address"],
-          "comment": row["comment"]
-      })
-    wines = []
-    cursor = self.Execute("SELECT * FROM wines WHERE lastchange>?",
-                          (client_knows_commit,))
-    for row in cursor:
-      wines.append({
-          "server_id": row["id"],
-          "vineyard_id": row["vineyard"],
-          "name": row["name"],
-          "grape": row["grape"],
-          "comment": row["comment"]
-      })
-    years = []
-    cursor = self.Execute("SELECT * FROM years WHERE lastchange>?",
-                          (client_knows_commit,))
-    for row in cursor:
-      years.append({
-          "server_id": row["id"],
-          "wine_id": row["wine"],
-          "year": row["year"],
-          "count": row["count"],
-          "stock": row["stock"],
-          "price": row["price"],
-          "rating": row["rating"],
-          "value": row["value"],
-          "sweetness": row["sweetness"],
-          "age": row["age"],
-          "age_update": row["age_update"],
-          "comment": row["comment"],
-          "location": row["location"]
-      })
-    log = []
-    cursor = self.Execute("SELECT * FROM log WHERE lastchange>?",
-                          (client_knows_commit,))
-    for row in cursor:
-      log.append({
-        "server_id": row["id"],
-        "date": row["date"],
-        "year_id": row["wine"],
-        "delta": row["delta"],
-        "reason": row["reason"],
-        "comment": row["comment"]
-      })
-    return {
-        "vineyards": vineyards,
-        "wines": wines,
-        "years": years,
-        "log": log,
-        "commit": self._lastchange,
-        "uuid": self.uuid,
-    }
+  # With |delta|, rows that the client already has only carry the fields that
+  # changed since |client_knows_commit|, plus the ones that identify them.
+  # Deleted years are tombstones: an initial sync leaves them out (unless the
+  # log refers to them), later syncs only send their count.
+  def GetAll2(self, client_knows_commit, delta=False):
+    with Snapshot(self) as snapshot:
+      return self._GetAll2(int(client_knows_commit), snapshot.commit, delta)
+
+  def _GetAll2(self, client_knows_commit, commit, delta):
+    result = {"commit": commit, "uuid": self.uuid}
+    tracked = self._IsTracked(client_knows_commit, delta)
+    for table in SYNC_COLUMNS:
+      rows = list(self._SyncCursor(table, client_knows_commit, commit, delta))
+      result[table] = self._SyncRows(table, rows, client_knows_commit, tracked)
+    return result
+
+  # Like GetAll2, but in pages of at most |page_size| rows, for initial syncs
+  # of large databases. Pass the "next_page_token" of a page to get the next
+  # one; only the last page has no token, and has the "commit" the client is
+  # then up to date with. Pages are read at different times, so they may
+  # contain rows changed after that commit; those are sent again by the next
+  # sync, which makes the result consistent.
+  def GetAll2Page(self, client_knows_commit, page_size, page_token=None,
+                  delta=False):
+    page_size = max(1, min(int(page_size), SYNC_PAGE_MAX))
+    with Snapshot(self) as snapshot:
+      if page_token is None:
+        client_knows_commit = int(client_knows_commit)
+        commit, table_index, after = snapshot.commit, 0, 0
+      else:
+        client_knows_commit, commit, table_index, after = (
+            _DecodePageToken(page_token))
+      tracked = self._IsTracked(client_knows_commit, delta)
+      result = {"uuid": self.uuid}
+      tables = list(SYNC_COLUMNS)
+      for i, table in enumerate(tables[table_index:], table_index):
+        rows = list(self._SyncCursor(table, client_knows_commit, commit,
+                                     delta, after, page_size))
+        result[table] = self._SyncRows(table, rows, client_knows_commit,
+                                       tracked)
+        page_size -= len(rows)
+        if page_size == 0:
+          result["next_page_token"] = _EncodePageToken(
+              client_knows_commit, commit, i, rows[-1]["id"])
+          return result
+        after = 0
+      result["commit"] = commit
+      return result
+
+  def _IsTracked(self, client_knows_commit, delta):
+    if not delta or client_knows_commit == 0: return False
+    since = self.Execute(
+        "SELECT value FROM data WHERE key='field_changes_since'").fetchone()
+    return client_knows_commit >= int(since["value"])
+
+  # The rows of |table| changed since |client_knows_commit|; for pages, the
+  # first |limit| of them with an id above |after|.
+  def _SyncCursor(self, table, client_knows_commit, commit, delta, after=None,
+                  limit=None):
+    condition = "lastchange>?"
+    args = [client_knows_commit]
+    if delta and client_knows_commit == 0 and table == "years":
+      # Years deleted after |commit| are sent: the next sync will only send
+      # their count.
+      condition += """ AND (count >= 0 OR lastchange>? OR EXISTS (
+          SELECT 1 FROM log WHERE log.wine = years.id))"""
+      args.append(commit)
+    if limit is None:
+      return self.Execute(f"SELECT * FROM {table} WHERE {condition}", args)
+    return self.Execute(
+        f"SELECT * FROM {table} WHERE {condition} AND id>? ORDER BY id LIMIT ?",
+        args + [after, limit])
+
+  def _SyncRows(self, table, rows, client_knows_commit, tracked):
+    identity, columns = SYNC_COLUMNS[table]
+    if not tracked:
+      return [{name: row[c] for c, name in identity + columns} for row in rows]
+    if not rows: return []
+    changes = {}
+    ids = [row["id"] for row in rows]
+    c = self.Execute(
+        """SELECT row, field FROM field_changes
+           WHERE tbl=? AND lastchange>? AND row BETWEEN ? AND ?""",
+        (table, client_knows_commit, min(ids), max(ids)))
+    for row in c:
+      changes.setdefault(row["row"], set()).add(row["field"])
+    result = []
+    for row in rows:
+      fields = changes.get(row["id"])
+      # Rewritten with the same values.
+      if fields is None: continue
+      if "*" in fields:
+        send = identity + columns
+      elif table == "years" and row["count"] < 0:
+        if "count" not in fields: continue
+        send = identity + [("count", "count")]
+      else:
+        send = identity + [(c, name) for c, name in columns if c in fields]
+      result.append({name: row[c] for c, name in send})
+    return result
+
+  # The last committed change, as reported by GetAll2.
+  def GetCommit(self):
+    return self._committed
+
+  # Calls |callback(commit)| after every commit. It runs on the committing
+  # thread with the write lock held, so it must be quick.
+  def AddChangeListener(self, callback):
+    with self._write_lock:
+      self._change_listeners.append(callback)
+
+  def RemoveChangeListener(self, callback):
+    with self._write_lock:
+      self._change_listeners.remove(callback)
+
+  # Blocks until something has been committed after |client_knows_commit|,
+  # or until |timeout| seconds have passed. Used for long polling.
+  def WaitForChange(self, client_knows_commit, timeout):
+    with self._changed:
+      self._changed.wait_for(
+          lambda: (self._committed != client_knows_commit or
+                   self._shutting_down),
+          timeout)
 
   def Set(self, postdata):
-    if postdata.get("extra_backup", default=False):
+    if postdata.get("extra_backup", False):
       self._ExtraBackup()
     with Update(self):
       result = {}
       receipts = {}
       if "vineyards" in postdata:
-        vineyard_receipts = []
-        for vineyard in postdata["vineyards"]:
-          server_id = self._SetVineyard(vineyard)
-          vineyard_receipts.append({
-              "server_id": server_id,
-              "local_id": vineyard["local_id"]
-          })
-        receipts["vineyards"] = vineyard_receipts
+        receipts["vineyards"] = self._SetVineyards(postdata["vineyards"])
       if "wines" in postdata:
-        wine_receipts = []
-        for wine in postdata["wines"]:
-          if wine["vineyard_id"] == 0: continue
-          server_id = self._SetWine(wine)
-          wine_receipts.append({
-              "server_id": server_id,
-              "local_id": wine["local_id"]
-          })
-        receipts["wines"] = wine_receipts
+        wines = [w for w in postdata["wines"] if w["vineyard_id"] != 0]
+        receipts["wines"] = self._SetWines(wines)
       if "years" in postdata:
-        year_receipts = []
-        for year in postdata["years"]:
-          if year["wine_id"] == 0: continue
-          server_id = self._SetYear(year)
-          year_receipts.append({
-              "server_id": server_id,
-              "local_id": year["local_id"]
-          })
-        receipts["years"] = year_receipts
+        years = [y for y in postdata["years"] if y["wine_id"] != 0]
+        receipts["years"] = self._SetYears(years)
       if "log" in postdata:
-        log_receipts = []
-        for log in postdata["log"]:
-          if log["year_id"] == 0: continue
-          server_id = self._SetLog(log)
-          log_receipts.append({
-            "server_id": server_id,
-            "local_id": log["local_id"]
-          })
-        receipts["log"] = log_receipts
+        log = [l for l in postdata["log"] if l["year_id"] != 0]
+        receipts["log"] = self._SetLogs(log)
       if len(receipts) > 0:
         result["receipts"] = receipts
       result["commit"] = self._lastchange
       return result
 
-  def _AddVineyard(self, v):
-    print(f"INSERT vineyard: {v}")
-    c = self.Execute("""
-        INSERT INTO vineyards(name, country, region, address, website,
-                              comment, lastchange)
-        VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (v["name"], v["country"], v["region"], v["address"], v["website"],
-          v["comment"], self._lastchange))
-    return c.lastrowid
-
-  def _SetVineyard(self, v):
-    server_id = v["server_id"]
-    if not server_id:
-      c = self.Execute("SELECT * FROM vineyards WHERE name=?", (v["name"],))
-      r = c.fetchone()
-      if r is None:
-        return self._AddVineyard(v)
-      server_id = r["id"]
-    else:
-      c = self.Execute("SELECT * FROM vineyards WHERE id=?", (server_id,))
-      r = c.fetchone()
-      if r is None:
-        return self._AddVineyard(v)
-    print(f"UPDATE vineyard: {v}")
-    self.Execute("""
-        UPDATE vineyards
-        SET name=?, country=?, region=?, address=?, website=?, comment=?,
-            lastchange=?
-        WHERE id=?""",
-        (v["name"], v["country"], v["region"], v["address"], v["website"],
-         v["comment"], self._lastchange, server_id))
-    return server_id
-
-  def _AddWine(self, w):
-    print(f"INSERT wine: {w}")
-    c = self.Execute("""
-        INSERT INTO wines(vineyard, name, grape, comment, lastchange)
-        VALUES (?, ?, ?, ?, ?)""",
-        (w["vineyard_id"], w["name"], w["grape"], w["comment"],
-          self._lastchange))
-    return c.lastrowid
-
-  def _SetWine(self, w):
-    server_id = w["server_id"]
-    if not server_id:
-      c = self.Execute("SELECT * FROM wines WHERE name=? AND vineyard=?",
-      (w["name"], w["vineyard_id"]))
-      r = c.fetchone()
-      if r is None:
-        return self._AddWine(w)
-      server_id = r["id"]
-    else:
-      c = self.Execute("SELECT * FROM wines WHERE id=?", (server_id,))
-      r = c.fetchone()
-      if r is None:
-        return self._AddWine(w)
-      if r["vineyard"] == 0:
+  # Loads the rows of |table| that a batch of pushed rows may refer to: those
+  # with one of the given |ids|, and those whose natural key (the values of
+  # |columns|) is one of |keys|. One query per chunk of ids or keys.
+  def _FindRows(self, table, columns, keys, ids):
+    known = KnownRows(columns)
+    selected = ", ".join(f"{table}.{column}" for column in columns)
+    ids = list(set(ids))
+    for i in range(0, len(ids), BATCH_SIZE):
+      chunk = ids[i:i + BATCH_SIZE]
+      placeholders = ", ".join("?" * len(chunk))
+      c = self.Execute(f"""
+          SELECT id, {selected} FROM {table}
+          WHERE id IN ({placeholders})""", chunk)
+      for row in c:
+        known.Add(row[0], tuple(row[1:]))
+    keys = list(set(keys))
+    names = ", ".join(f"k{i}" for i in range(len(columns)))
+    condition = " AND ".join(f"{table}.{column} = k{i}"
+                             for i, column in enumerate(columns))
+    row_placeholder = "(" + ", ".join("?" * len(columns)) + ")"
+    for i in range(0, len(keys), BATCH_SIZE):
+      chunk = keys[i:i + BATCH_SIZE]
+      values = ", ".join([row_placeholder] * len(chunk))
+      args = [value for key in chunk for value in key]
+      c = self.Execute(f"""
+          WITH keys({names}) AS (VALUES {values})
+          SELECT {table}.id, {selected} FROM keys
+          INNER JOIN {table} ON {condition}""", args)
+      for row in c:
+        known.Add(row[0], tuple(row[1:]))
+    return known
+
+  def _NextId(self, table):
+    maybe = self.Execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+    return maybe + 1 if maybe is not None else 1
+
+  def _SetVineyards(self, vineyards):
+    known = self._FindRows(
+        "vineyards", ("name",),
+        [(v["name"],) for v in vineyards if not v["server_id"]],
+        [v["server_id"] for v in vineyards if v["server_id"]])
+    next_id = self._NextId("vineyards")
+    statements = BatchStatements(self)
+    receipts = []
+    for v in vineyards:
+      server_id = known.Resolve(v["server_id"], (v["name"],))
+      if server_id is None:
+        logger.debug("INSERT vineyard: %s", v)
+        server_id = next_id
+        next_id += 1
+        statements.Add("""
+            INSERT INTO vineyards(id, name, country, region, address, website,
+                                  comment, lastchange)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (server_id, v["name"], v["country"], v["region"], v["address"],
+             v["website"], v["comment"], self._lastchange))
+      else:
+        logger.debug("UPDATE vineyard: %s", v)
+        statements.Add("""
+            UPDATE vineyards
+            SET name=?, country=?, region=?, address=?, website=?, comment=?,
+                lastchange=?
+            WHERE id=?""",
+            (v["name"], v["country"], v["region"], v["address"], v["website"],
+             v["comment"], self._lastchange, server_id))
+      known.Add(server_id, (v["name"],))
+      receipts.append({"server_id": server_id, "local_id": v["local_id"]})
+    statements.Flush()
+    return receipts
+
+  def _SetWines(self, wines):
+    known = self._FindRows(
+        "wines", ("vineyard", "name"),
+        [(w["vineyard_id"], w["name"]) for w in wines if not w["server_id"]],
+        [w["server_id"] for w in wines if w["server_id"]])
+    next_id = self._NextId("wines")
+    statements = BatchStatements(self)
+    receipts = []
+    for w in wines:
+      server_id = known.Resolve(w["server_id"], (w["vineyard_id"], w["name"]))
+      if server_id is None:
+        logger.debug("INSERT wine: %s", w)
+        server_id = next_id
+        next_id += 1
+        statements.Add("""
+            INSERT INTO wines(id, vineyard, name, grape, comment, lastchange)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (server_id, w["vineyard_id"], w["name"], w["grape"], w["comment"],
+             self._lastchange))
+        known.Add(server_id, (w["vineyard_id"], w["name"]))
+      elif known.Get(server_id)[0] == 0:
         # This case (and the equivalents for years and logs) serves to recover
         # from a bug found in 2023-10. We can probably delete it after a while.
-        print(f"UPDATE wine (new vineyard): {w}")
-        self.Execute("""
+        logger.debug("UPDATE wine (new vineyard): %s", w)
+        statements.Add("""
             UPDATE wines
             SET vineyard=?, name=?, grape=?, comment=?, lastchange=?
             WHERE id=?""",
             (w["vineyard_id"], w["name"], w["grape"], w["comment"],
              self._lastchange, server_id))
-        return server_id
-    print(f"UPDATE wine: {w}")
-    self.Execute(
-        "UPDATE wines SET name=?, grape=?, comment=?, lastchange=? WHERE id=?",
-        (w["name"], w["grape"], w["comment"], self._lastchange, server_id))
-    return server_id
-
-  def _AddYear2(self, y):
-    print(f"INSERT year: {y}")
-    c = self.Execute("""
-        INSERT INTO years(wine, year, count, stock, price, rating, value,
-                          sweetness, age, age_update, comment, location,
-                          lastchange)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (y["wine_id"], y["year"], y["count"], y["stock"], y["price"],
-          y["rating"], y["value"], y["sweetness"], y["age"], y["age_update"],
-          y["comment"], y["location"], self._lastchange))
-    return c.lastrowid
-
-  def _SetYear(self, y):
-    server_id = y["server_id"]
-    if not server_id:
-      c = self.Execute("SELECT * FROM years WHERE year=? AND wine=?",
-                       (y["year"], y["wine_id"]))
-      r = c.fetchone()
-      if r is None:
-        return self._AddYear2(y)
-      server_id = r["id"]
-    else:
-      c = self.Execute("SELECT * FROM years WHERE id=?", (server_id,))
-      r = c.fetchone()
-      if r is None:
-        return self._AddYear2(y)
-      if r["wine"] == 0:
-        print(f"UPDATE year (new wine): {y}")
-        self.Execute("""
+        known.Add(server_id, (w["vineyard_id"], w["name"]))
+      else:
+        logger.debug("UPDATE wine: %s", w)
+        statements.Add(
+            "UPDATE wines SET name=?, grape=?, comment=?, lastchange=? WHERE id=?",
+            (w["name"], w["grape"], w["comment"], self._lastchange, server_id))
+        known.Add(server_id, (known.Get(server_id)[0], w["name"]))
+      receipts.append({"server_id": server_id, "local_id": w["local_id"]})
+    statements.Flush()
+    return receipts
+
+  def _SetYears(self, years):
+    known = self._FindRows(
+        "years", ("wine", "year"),
+        [(y["wine_id"], y["year"]) for y in years if not y["server_id"]],
+        [y["server_id"] for y in years if y["server_id"]])
+    next_id = self._NextId("years")
+    statements = BatchStatements(self)
+    receipts = []
+    for y in years:
+      server_id = known.Resolve(y["server_id"], (y["wine_id"], y["year"]))
+      if server_id is None:
+        logger.debug("INSERT year: %s", y)
+        server_id = next_id
+        next_id += 1
+        statements.Add("""
+            INSERT INTO years(id, wine, year, count, stock, price, rating, value,
+                              sweetness, age, age_update, comment, location,
+                              lastchange)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (server_id, y["wine_id"], y["year"], y["count"], y["stock"],
+             y["price"], y["rating"], y["value"], y["sweetness"], y["age"],
+             y["age_update"], y["comment"], y["location"], self._lastchange))
+        known.Add(server_id, (y["wine_id"], y["year"]))
+      elif known.Get(server_id)[0] == 0:
+        logger.debug("UPDATE year (new wine): %s", y)
+        statements.Add("""
             UPDATE years
             SET wine=?, count=?, stock=?, price=?, rating=?, value=?,
                 sweetness=?, age=?, age_update=?, comment=?, location=?,
@@ -565,59 +1458,65 @@ class Manager:
             (y["wine_id"], y["count"], y["stock"], y["price"], y["rating"],
              y["value"], y["sweetness"], y["age"], y["age_update"],
              y["comment"], y["location"], self._lastchange, server_id))
-        return server_id
-    print(f"UPDATE year: {y}")
-    self.Execute("""
-        UPDATE years
-        SET count=?, stock=?, price=?, rating=?, value=?, sweetness=?, age=?,
-            age_update=?, comment=?, location=?, lastchange=?
-        WHERE id=?""",
-        (y["count"], y["stock"], y["price"], y["rating"], y["value"],
-         y["sweetness"], y["age"], y["age_update"], y["comment"], y["location"],
-         self._lastchange, server_id))
-    return server_id
-
-  def _AddLog(self, l):
-    print(f"INSERT log: {l}")
-    c = self.Execute("""
-        INSERT INTO log(date, wine, delta, reason, comment, lastchange)
-        VALUES (?, ?, ?, ?, ?, ?)""",
-        (l["date"], l["year_id"], l["delta"], l["reason"], l["comment"],
-          self._lastchange))
-    return c.lastrowid
-
-  def _SetLog(self, l):
-    server_id = l["server_id"]
-    if not server_id:
-      c = self.Execute("SELECT * FROM log WHERE date=? AND wine=?",
-                       (l["date"], l["year_id"]))
-      r = c.fetchone()
-      if r is None:
-        return self._AddLog(l)
-      server_id = r["id"]
-    else:
-      c = self.Execute("SELECT * FROM log WHERE id=?", (server_id,))
-      r = c.fetchone()
-      if r is None:
-        return self._AddLog(l)
-      if r["wine"] == 0:
-        print(f"UPDATE log (new wine): {l}")
-        self.Execute("""
+        known.Add(server_id, (y["wine_id"], known.Get(server_id)[1]))
+      else:
+        logger.debug("UPDATE year: %s", y)
+        statements.Add("""
+            UPDATE years
+            SET count=?, stock=?, price=?, rating=?, value=?, sweetness=?,
+                age=?, age_update=?, comment=?, location=?, lastchange=?
+            WHERE id=?""",
+            (y["count"], y["stock"], y["price"], y["rating"], y["value"],
+             y["sweetness"], y["age"], y["age_update"], y["comment"],
+             y["location"], self._lastchange, server_id))
+      receipts.append({"server_id": server_id, "local_id": y["local_id"]})
+    statements.Flush()
+    return receipts
+
+  def _SetLogs(self, log):
+    known = self._FindRows(
+        "log", ("wine", "date"),
+        [(l["year_id"], l["date"]) for l in log if not l["server_id"]],
+        [l["server_id"] for l in log if l["server_id"]])
+    next_id = self._NextId("log")
+    statements = BatchStatements(self)
+    receipts = []
+    for l in log:
+      key = known.Normalize((l["year_id"], l["date"]))
+      server_id = known.Resolve(l["server_id"], key)
+      if server_id is not None and l["server_id"]:
+        existing = known.Get(server_id)
+        if existing[0] != 0 and existing != key:
+          # Recover from traces of 2023-10 bug.
+          logger.debug("mismatch detected for log %s", server_id)
+          server_id = None
+      if server_id is None:
+        logger.debug("INSERT log: %s", l)
+        server_id = next_id
+        next_id += 1
+        statements.Add("""
+            INSERT INTO log(id, date, wine, delta, reason, comment, lastchange)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (server_id, l["date"], l["year_id"], l["delta"], l["reason"],
+             l["comment"], self._lastchange))
+        known.Add(server_id, key)
+      elif known.Get(server_id)[0] == 0:
+        logger.debug("UPDATE log (new wine): %s", l)
+        statements.Add("""
             UPDATE log
             SET wine=?, delta=?, reason=?, comment=?, lastchange=?
             WHERE id=?""",
             (l["year_id"], l["delta"], l["reason"], l["comment"],
              self._lastchange, server_id))
-        return server_id
-      if r["wine"] != l["year_id"] or r["date"] != l["date"]:
-        # Recover from traces of 2023-10 bug.
-        print("mismatch detected -> ", end=None)
-        return self._AddLog(l)
-    print(f"UPDATE log: {l}")
-    self.Execute(
-        "UPDATE log SET delta=?, reason=?, comment=?, lastchange=? WHERE id=?",
-        (l["delta"], l["reason"], l["comment"], self._lastchange, server_id))
-    return server_id
+        known.Add(server_id, (l["year_id"], known.Get(server_id)[1]))
+      else:
+        logger.debug("UPDATE log: %s", l)
+        statements.Add(
+            "UPDATE log SET delta=?, reason=?, comment=?, lastchange=? WHERE id=?",
+            (l["delta"], l["reason"], l["comment"], self._lastchange, server_id))
+      receipts.append({"server_id": server_id, "local_id": l["local_id"]})
+    statements.Flush()
+    return receipts
 
   def Special(self, requested):
     if requested == "consistency":
@@ -640,6 +1539,11 @@ class Manager:
           "log": log,
         }
       }
+    if requested == "verify_totals":
+      return {"mismatches": self.VerifyTotals()}
+    if requested == "rebuild_totals":
+      self.RebuildTotals()
+      return {"mismatches": self.VerifyTotals()}
 
   ################# LEGACY (v1) FUNCTIONALITY ######################
 
@@ -749,7 +1653,7 @@ class Manager:
           (count, rating, price, comment, self._lastchange, year_id))
       self.Log(year_id, count, reason)
     else:
-      print("Tried to add existing year, ignoring")
+      logger.warning("Tried to add existing year, ignoring")
 
   def AddYear(self, wine_id, year, count, rating, price, comment, reason):
     with Update(self):
@@ -804,23 +1708,60 @@ class Manager:
                    (self._lastchange, year_id))
     return self._GetCurrentStock(year_id)
 
+  # Stock-taking in bulk, in one transaction: each entry either adds "delta"
+  # to the stock of year "year_id", or sets it to "stock". Entries apply in
+  # order. Returns the new stock of the touched years that exist.
+  def SetStock(self, entries):
+    if not isinstance(entries, list):
+      raise TypeError(f"Expected a list of entries: {entries!r}")
+    changes = []
+    for entry in entries:
+      if not isinstance(entry, dict):
+        raise TypeError(f"Expected an entry object: {entry!r}")
+      stock = entry.get("stock")
+      if stock is None:
+        changes.append((None, int(entry["delta"]), int(entry["year_id"])))
+      else:
+        changes.append((int(stock), 0, int(entry["year_id"])))
+    with Update(self):
+      self.ExecuteMany(
+          """UPDATE years SET stock=COALESCE(?, stock + ?), lastchange=?
+             WHERE id=?""",
+          [(stock, delta, self._lastchange, year_id)
+           for stock, delta, year_id in changes])
+      year_ids = sorted({year_id for _, _, year_id in changes})
+      years = {}
+      for i in range(0, len(year_ids), BATCH_SIZE):
+        chunk = year_ids[i:i + BATCH_SIZE]
+        placeholders = ", ".join("?" * len(chunk))
+        c = self.Execute(
+            f"SELECT id, stock FROM years WHERE id IN ({placeholders})", chunk)
+        for row in c:
+          years[row["id"]] = {"stock": row["stock"]}
+      return {"years": years, "commit": self._lastchange}
+
   def _ApplyStockYear(self, year_id):
     self.Execute("UPDATE years SET count=stock, lastchange=? WHERE id=?",
                  (self._lastchange, year_id))
 
+  # Reports the stock applied to each year that had count >= 0, even where
+  # the stock is negative, so the year's count ends up negative.
   def _ApplyStockWine(self, wine_id, result):
-    yc = self.Execute(
-        "SELECT id, stock FROM years WHERE wine=? AND count >= 0", (wine_id,))
-    for year_row in yc:
-      year_id = year_row["id"]
-      self._ApplyStockYear(year_id)
-      result[year_id] = {"count": year_row["stock"]}
+    self._ApplyStockYears("wine=?", (wine_id,), result)
 
   def _ApplyStockVineyard(self, vineyard_id, result):
-    wc = self.Execute("SELECT id FROM wines WHERE vineyard=?", (vineyard_id,))
-    for wine_row in wc:
-      wine_id = wine_row["id"]
-      self._ApplyStockWine(wine_id, result)
+    self._ApplyStockYears("wine IN (SELECT id FROM wines WHERE vineyard=?)",
+                          (vineyard_id,), result)
+
+  def _ApplyStockYears(self, condition, args, result):
+    yc = self.Execute(
+        f"SELECT id, stock FROM years WHERE count >= 0 AND {condition}", args)
+    for year_row in yc:
+      result[year_row["id"]] = {"count": year_row["stock"]}
+    self.Execute(
+        f"""UPDATE years SET count=stock, lastchange=?
+            WHERE count >= 0 AND {condition}""",
+        (self._lastchange, *args))
 
   def ApplyStock(self, year_id):
     with Update(self):
@@ -873,60 +1814,102 @@ class Manager:
           (val, self._lastchange, year_id))
 
   def GetAll(self, only_existing):
+    # One pass over all (vineyard, wine, year) triples. Vineyards and wines
+    # without any matching years don't appear, just like in the nested result.
+    condition = "years.count > 0" if int(only_existing) else "years.count >= 0"
+    c = self.Execute(f"""
+      SELECT vineyards.id AS vineyard_id, vineyards.name AS vineyard_name,
+             vineyards.region AS region,
+             wines.id AS wine_id, wines.name AS wine_name, wines.grape AS grape,
+             years.id AS year_id, years.year AS year, years.count AS count,
+             years.stock AS stock, years.price AS price,
+             years.rating AS rating, years.value AS value,
+             years.sweetness AS sweetness, years.age AS age,
+             years.comment AS comment
+      FROM vineyards
+      INNER JOIN wines ON wines.vineyard = vineyards.id
+      INNER JOIN years ON years.wine = wines.id
+      WHERE {condition}
+      ORDER BY vineyards.id, wines.id, years.id""")
     result = {}
-    vc = self.Execute("SELECT * FROM vineyards")
-    for vineyard_row in vc:
-      wines = {}
-      vineyard_data = {"wines": wines, "id": vineyard_row["id"],
-                       "region": vineyard_row["region"]}
-      wc = self.Execute("SELECT * FROM wines WHERE vineyard=?",
-                        (vineyard_row["id"],))
-      have_one_wine = False
-      for wine_row in wc:
+    vineyard_id = None
+    wine_id = None
+    for row in c:
+      if row["vineyard_id"] != vineyard_id:
+        vineyard_id = row["vineyard_id"]
+        wines = {}
+        result[row["vineyard_name"]] = {"wines": wines, "id": vineyard_id,
+                                        "region": row["region"]}
+        wine_id = None
+      if row["wine_id"] != wine_id:
+        wine_id = row["wine_id"]
         years = {}
-        wine_data = {"years": years, "id": wine_row["id"],
-                     "grape": wine_row["grape"]}
-        query = "SELECT * FROM years WHERE wine=?"
-        if int(only_existing):
-          query += " AND count > 0"
-        else:
-          query += " AND count >= 0"
-        yc = self.Execute(query, (wine_row["id"],))
-        have_one_year = False
-        for year_row in yc:
-          have_one_year = True
-          years[year_row["year"]] = {
-            "year_id": year_row["id"],
-            "count": year_row["count"],
-            "stock": year_row["stock"],
-            "price": year_row["price"],
-            "rating": year_row["rating"],
-            "value": year_row["value"],
-            "sweetness": year_row["sweetness"],
-            "age": year_row["age"],
-            "comment": year_row["comment"]
-          }
-        if have_one_year:
-          wines[wine_row["name"]] = wine_data
-          have_one_wine = True
-      if have_one_wine:
-        result[vineyard_row["name"]] = vineyard_data
+        wines[row["wine_name"]] = {"years": years, "id": wine_id,
+                                   "grape": row["grape"]}
+      years[row["year"]] = {
+        "year_id": row["year_id"],
+        "count": row["count"],
+        "stock": row["stock"],
+        "price": row["price"],
+        "rating": row["rating"],
+        "value": row["value"],
+        "sweetness": row["sweetness"],
+        "age": row["age"],
+        "comment": row["comment"]
+      }
     return result
 
   def GetSortKey(self, sortby):
     w = sortby.split("_")
     sortby = w[0]
-    if sortby not in ("count", "price", "rating", "year", "value", "sweetness",
-                      "age"):
+    if sortby not in SORT_COLUMNS:
       sortby = "price"
-    direction = w[1]
+    direction = w[1] if len(w) > 1 else "asc"
     if direction not in ("asc", "desc"): direction = "asc"
     return f"{sortby} {direction}"
 
-  def GetSorted(self, only_existing, sortby):
+  # |filters| maps SORT_FILTERS names to values, e.g. {"grape": "Riesling"}.
+  def GetSorted(self, only_existing, sortby, filters=None):
+    return self._GetSorted(only_existing, sortby, filters)
+
+  # Like GetSorted, in pages of |limit| years. Pass the returned
+  # "next_page_token" to get the next page; the last page has none.
+  def GetSortedPage(self, only_existing, sortby, limit, page_token=None,
+                    filters=None):
+    limit = max(1, min(int(limit), SORTED_PAGE_MAX))
+    after = None
+    if page_token is not None:
+      after = _DecodeSortedPageToken(page_token)
+    rows = self._GetSorted(only_existing, sortby, filters, after, limit + 1)
+    result = {"rows": rows[:limit]}
+    if len(rows) > limit:
+      column = self.GetSortKey(sortby).split(" ")[0]
+      last = rows[limit - 1]
+      result["next_page_token"] = _EncodeSortedPageToken(last[column],
+                                                         last["year_id"])
+    return result
+
+  # Ordered by the sort column, then by id, so that (value, id) of the last
+  # row of a page says where the next one starts.
+  def _GetSorted(self, only_existing, sortby, filters, after=None,
+                 limit=None):
+    column, direction = self.GetSortKey(sortby).split(" ")
+    conditions = ["years.count > 0" if int(only_existing)
+                  else "years.count >= 0"]
+    args = []
+    for name, value in (filters or {}).items():
+      condition, convert = SORT_FILTERS[name]
+      conditions.append(condition)
+      args.append(convert(value))
+    if after is not None:
+      condition, after_args = _SortedAfter(column, direction, *after)
+      conditions.append(condition)
+      args.extend(after_args)
+    limit_clause = ""
+    if limit is not None:
+      limit_clause = "LIMIT ?"
+      args.append(limit)
     result = []
-    sortby = self.GetSortKey(sortby)
-    condition = "count > 0" if only_existing else "count >= 0"
     c = self.Execute(f"""
       SELECT years.id as year_id, years.year as year, years.count as count,
              years.stock as stock,
@@ -939,8 +1922,9 @@ class Manager:
       FROM years
       INNER JOIN wines ON years.wine = wines.id
       INNER JOIN vineyards ON wines.vineyard = vineyards.id
-      WHERE {condition}
-      ORDER BY {sortby}""")
+      WHERE {" AND ".join(conditions)}
+      ORDER BY years.{column} {direction}, years.id {direction}
+      {limit_clause}""", args)
     for r in c:
       result.append({
         "year_id": r["year_id"],
@@ -961,6 +1945,30 @@ class Manager:
         "region": r["region"]})
     return result
 
+  # Years matching |text|, best matches first. Deleted years are left out,
+  # and empty ones too unless |only_existing| is false.
+  def Search(self, text, limit=50, only_existing=True):
+    query = _SearchQuery(text)
+    if not query: return []
+    condition = "years.count > 0" if only_existing else "years.count >= 0"
+    weights = ", ".join(str(w) for w in SEARCH_WEIGHTS)
+    c = self.Execute(f"""
+      SELECT years.id AS year_id, years.year AS year, years.count AS count,
+             years.price AS price, years.rating AS rating,
+             years.comment AS comment, years.location AS location,
+             wines.id AS wine_id, wines.name AS wine_name,
+             wines.grape AS grape, vineyards.id AS vineyard_id,
+             vineyards.name AS vineyard_name, vineyards.region AS region,
+             vineyards.country AS country
+      FROM search
+      INNER JOIN years ON years.id = search.rowid
+      INNER JOIN wines ON years.wine = wines.id
+      INNER JOIN vineyards ON wines.vineyard = vineyards.id
+      WHERE search MATCH ? AND {condition}
+      ORDER BY bm25(search, {weights})
+      LIMIT ?""", (query, limit))
+    return [dict(r) for r in c]
+
   def GetVineyards(self):
     result = []
     c = self.Execute("SELECT name FROM vineyards")
@@ -980,16 +1988,7 @@ class Manager:
     return result
 
   def GetVineyardData(self, vineyard_id):
-    c = self.Execute("""
-        SELECT SUM(years.count) AS count,
-               SUM(years.count * years.price) AS price
-        FROM years
-        JOIN wines ON years.wine = wines.id
-        JOIN vineyards ON wines.vineyard = vineyards.id
-        WHERE vineyards.id=? AND years.count > 0""", (vineyard_id,))
-    r = c.fetchone()
-    total_count = r["count"]
-    total_price = r["price"]
+    total_count, total_price = self._GetTotals(vineyard_id)
     c = self.Execute("SELECT * FROM vineyards WHERE id=?", (vineyard_id,))
     r = c.fetchone()
     return {"id": r["id"],
@@ -1069,12 +2068,55 @@ class Manager:
     return {"id": r["id"], "name": r["name"], "grape": r["grape"]}
 
   def GetTotals(self):
-    c = self.Execute("""
-        SELECT SUM(count) AS count, SUM(count * price) AS price
-        FROM years
-        WHERE count > 0""")
-    r = c.fetchone()
-    return {"count": r["count"], "price": r["price"]}
+    count, price = self._GetTotals(TOTALS_ALL)
+    return {"count": count, "price": price}
+
+  # Bottles added and removed per |period| ("day" or "month") between the
+  # dates |start| and |end| (inclusive, YYYY-MM-DD), per LOG_SERIES_KEYS
+  # grouping |by|, optionally for one wine or vineyard only.
+  def GetLogSeries(self, period="month", start=None, end=None, by="total",
+                   wine=None, vineyard=None):
+    if period not in LOG_ROLLUPS:
+      raise ValueError(f"Unknown period: {period}")
+    if by not in LOG_SERIES_KEYS:
+      raise ValueError(f"Unknown grouping: {by}")
+    length = 10 if period == "day" else 7
+    conditions = ["true"]
+    args = []
+    if start is not None:
+      conditions.append("rollups.period >= ?")
+      args.append(datetime.date.fromisoformat(start).isoformat()[:length])
+    if end is not None:
+      conditions.append("rollups.period <= ?")
+      args.append(datetime.date.fromisoformat(end).isoformat()[:length])
+    if wine is not None:
+      conditions.append("rollups.wine = ?")
+      args.append(int(wine))
+    if vineyard is not None:
+      conditions.append("wines.vineyard = ?")
+      args.append(int(vineyard))
+    c = self.Execute(f"""
+      SELECT rollups.period AS period, {LOG_SERIES_KEYS[by]} AS key,
+             SUM(rollups.added) AS added, SUM(rollups.removed) AS removed
+      FROM {LOG_ROLLUPS[period]} AS rollups
+      INNER JOIN wines ON rollups.wine = wines.id
+      WHERE {" AND ".join(conditions)}
+      GROUP BY 1, 2
+      HAVING SUM(rollups.added) != 0 OR SUM(rollups.removed) != 0
+      ORDER BY 1, 2""", args)
+    series = []
+    for row in c:
+      entry = {"period": row["period"], "added": row["added"],
+               "removed": row["removed"]}
+      if by != "total": entry[by] = row["key"]
+      series.append(entry)
+    return {"period": period, "series": series}
+
+  # Bottles and value by country, region, grape, vintage, location and
+  # rating, see StatsCache.
+  def GetStats(self):
+    with Snapshot(self) as snapshot:
+      return self._stats.Get(snapshot.commit)
 
   #################  CSV Export. ###############################
   # (Remember to keep this when deleting v1!)
@@ -1092,6 +2134,8 @@ class Manager:
     d = datetime.date.fromtimestamp(timestamp)
     return d.isoformat()
 
+  # Generator yielding the export as UTF-8 encoded chunks of roughly
+  # EXPORT_CHUNK_SIZE, straight from the cursor.
   def ExportCSV(self):
     # Skip deleted years, but include empty years, in order to see
     # comments/ratings for them.
@@ -1120,10 +2164,14 @@ class Manager:
              self._FormatAge(r["age"]), self._FormatDate(r["age_update"]),
              r["location"], r["grape"]]
       writer.writerow(row)
-    return output.getvalue()
+      if output.tell() >= EXPORT_CHUNK_SIZE:
+        yield output.getvalue().encode("utf-8")
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue().encode("utf-8")
 
 if __name__ == '__main__':
   m = Manager(":memory:")
-  b = m.ExportCSV()
-  print(b)
+  b = b"".join(m.ExportCSV())
+  print(b.decode("utf-8"))
   m.Shutdown()
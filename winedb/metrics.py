@@ -0,0 +1,128 @@
+import bisect
+import re
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+_PLACEHOLDERS = re.compile(r"\?(\s*,\s*\?)+")
+_REPEATED_GROUPS = re.compile(r"(\([^()]*\))(\s*,\s*\1)+")
+
+# Batched statements have a variable number of placeholders; fold those so
+# that each statement is counted under one name.
+def NormalizeStatement(stmt):
+  stmt = " ".join(stmt.split())
+  stmt = _PLACEHOLDERS.sub("?, ...", stmt)
+  return _REPEATED_GROUPS.sub(r"\1, ...", stmt)
+
+def _Escape(value):
+  return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+          .replace('"', '\\"'))
+
+def _Labels(**labels):
+  return ",".join(f'{name}="{_Escape(value)}"'
+                  for name, value in labels.items())
+
+class Histogram:
+  def __init__(self):
+    self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, seconds):
+    self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    self.count += 1
+    self.sum += seconds
+
+# Request and SQL statement statistics, collected only when enabled in the
+# settings. Rendered in Prometheus' text format at /api/metrics.
+class Metrics:
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._started = time.time()
+    self._requests = {}  # (method, route, code) -> count
+    self._latencies = {}  # (method, route) -> Histogram
+    self._statements = {}  # normalized statement -> [count, seconds]
+    self._normalized = {}
+
+  def ObserveRequest(self, method, route, code, seconds):
+    with self._lock:
+      key = (method, route, code)
+      self._requests[key] = self._requests.get(key, 0) + 1
+      histogram = self._latencies.get((method, route))
+      if histogram is None:
+        histogram = self._latencies[(method, route)] = Histogram()
+      histogram.Observe(seconds)
+
+  def ObserveStatement(self, stmt, seconds):
+    name = self._normalized.get(stmt)
+    if name is None:
+      name = self._normalized[stmt] = NormalizeStatement(stmt)
+    with self._lock:
+      entry = self._statements.get(name)
+      if entry is None:
+        entry = self._statements[name] = [0, 0.0]
+      entry[0] += 1
+      entry[1] += seconds
+
+  # One line for the GUI, e.g. "120 Anfragen, langsamste: GET /get_all (12 ms)".
+  def Summary(self):
+    with self._lock:
+      total = sum(self._requests.values())
+      slowest = None
+      for (method, route), histogram in self._latencies.items():
+        average = histogram.sum / histogram.count
+        if slowest is None or average > slowest[0]:
+          slowest = (average, method, route)
+    if slowest is None: return "Noch keine Anfragen"
+    average, method, route = slowest
+    return (f"{total} Anfragen, langsamste: {method} {route} "
+            f"({average * 1000:.0f} ms)")
+
+  # |storage| is a dict of SQLite gauges, see Manager.GetStorageStats().
+  def Render(self, storage):
+    lines = []
+    def Header(name, kind, text):
+      lines.append(f"# HELP {name} {text}")
+      lines.append(f"# TYPE {name} {kind}")
+    with self._lock:
+      Header("winedb_uptime_seconds", "gauge",
+             "Seconds since metrics collection started.")
+      lines.append(f"winedb_uptime_seconds {time.time() - self._started:.3f}")
+
+      Header("winedb_http_requests_total", "counter",
+             "HTTP requests by route and status code.")
+      for (method, route, code), count in sorted(self._requests.items()):
+        labels = _Labels(method=method, route=route, code=code)
+        lines.append(f"winedb_http_requests_total{{{labels}}} {count}")
+
+      name = "winedb_http_request_duration_seconds"
+      Header(name, "histogram", "Time spent handling HTTP requests.")
+      for (method, route), histogram in sorted(self._latencies.items()):
+        labels = _Labels(method=method, route=route)
+        cumulative = 0
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+        for bound, count in zip(bounds, histogram.buckets):
+          cumulative += count
+          lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+      Header("winedb_sql_statements_total", "counter",
+             "Statements run through Manager.Execute/ExecuteMany.")
+      for stmt, (count, _) in sorted(self._statements.items()):
+        labels = _Labels(statement=stmt)
+        lines.append(f"winedb_sql_statements_total{{{labels}}} {count}")
+      Header("winedb_sql_statement_seconds_total", "counter",
+             "Time spent running statements, including fetching the rows.")
+      for stmt, (_, seconds) in sorted(self._statements.items()):
+        labels = _Labels(statement=stmt)
+        lines.append(
+            f"winedb_sql_statement_seconds_total{{{labels}}} {seconds:.6f}")
+
+    for key, value in sorted(storage.items()):
+      Header(f"winedb_sqlite_{key}", "gauge", f"SQLite {key}.")
+      lines.append(f"winedb_sqlite_{key} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,46 @@
+import gzip
+import json
+
+from .assets import AcceptedEncodings, MIN_COMPRESS_SIZE
+
+# The lists of rows in /api/get and /api/set payloads.
+TABLES = ("vineyards", "wines", "years", "log")
+
+# Columnar format: instead of a list of objects that all repeat the same
+# keys, each table is sent as {"keys": [...], "rows": [[...], ...]}.
+def ToColumns(data):
+  result = dict(data)
+  for table in TABLES:
+    if table not in data: continue
+    rows = data[table]
+    keys = sorted(rows[0].keys()) if rows else []
+    result[table] = {
+      "keys": keys,
+      "rows": [[row[key] for key in keys] for row in rows],
+    }
+  return result
+
+# Inverse of ToColumns. Tables that are already lists are left alone, so
+# this accepts both formats.
+def FromColumns(data):
+  result = dict(data)
+  for table in TABLES:
+    columns = data.get(table)
+    if not isinstance(columns, dict): continue
+    keys = columns["keys"]
+    result[table] = [dict(zip(keys, row)) for row in columns["rows"]]
+  return result
+
+# Returns (body, content_encoding) for |data|, gzipped if the client accepts
+# that and it's worth it.
+def EncodeJson(data, accept_encoding):
+  body = json.dumps(data, sort_keys=True).encode("utf-8")
+  if (len(body) >= MIN_COMPRESS_SIZE and
+      "gzip" in AcceptedEncodings(accept_encoding)):
+    return gzip.compress(body, 6), "gzip"
+  return body, None
+
+def DecodeBody(raw, content_encoding):
+  if content_encoding is not None and content_encoding.lower() == "gzip":
+    raw = gzip.decompress(raw)
+  return str(raw, encoding="utf-8")
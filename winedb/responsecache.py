@@ -0,0 +1,68 @@
+import collections
+import concurrent.futures
+import threading
+
+# Encoded /api/get responses of the current commit, so that clients asking
+# for the same sync (typically many of them reconnecting with last_commit=0)
+# share one computation and serialization. All entries are dropped when
+# something is committed; beyond |max_bytes|, the least recently used ones
+# are evicted.
+class ResponseCache:
+  def __init__(self, max_bytes):
+    self._max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._commit = None
+    self._entries = collections.OrderedDict()  # key -> (body, encoding)
+    self._size = 0
+    self._pending = {}  # key -> Future, for requests being computed
+    self.hits = 0
+    self.misses = 0
+
+  # Returns the cached (body, encoding) for |key| at |commit|, or calls
+  # |compute()| to produce it. Concurrent calls for the same key wait for
+  # the first one's result, including its exception.
+  def Get(self, commit, key, compute):
+    key = (commit, key)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+      future = self._pending.get(key)
+      owner = future is None
+      if owner:
+        future = self._pending[key] = concurrent.futures.Future()
+        self.misses += 1
+    if not owner:
+      return future.result()
+    try:
+      entry = compute()
+    except BaseException as e:
+      with self._lock:
+        del self._pending[key]
+      future.set_exception(e)
+      raise
+    with self._lock:
+      del self._pending[key]
+      self._Store(commit, key, entry)
+    future.set_result(entry)
+    return entry
+
+  # Called with the lock held.
+  def _Store(self, commit, key, entry):
+    size = len(entry[0])
+    # Results computed across a commit are outdated already.
+    if commit != self._commit or size > self._max_bytes: return
+    self._entries[key] = entry
+    self._size += size
+    while self._size > self._max_bytes:
+      _, (body, _) = self._entries.popitem(last=False)
+      self._size -= len(body)
+
+  # To be registered with Manager.AddChangeListener().
+  def Invalidate(self, commit):
+    with self._lock:
+      self._commit = commit
+      self._entries.clear()
+      self._size = 0
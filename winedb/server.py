@@ -1,310 +1,575 @@
 from datetime import date
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import logging
 import threading
+import time
 import urllib
 
-from .manager import Manager
+from .assets import AcceptedEncodings, AssetCache, EtagMatches
+from .manager import Manager, SORT_FILTERS
+from .metrics import Metrics
+from .payload import DecodeBody, EncodeJson, FromColumns, ToColumns
+from .responsecache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for how long an /api/get long poll may be held open.
+MAX_LONG_POLL_SECONDS = 60
+# Upper bound for the number of results of one /api/search request.
+MAX_SEARCH_RESULTS = 500
+# Default for how long an idle keep-alive connection stays open.
+KEEP_ALIVE_TIMEOUT = 30
+# Default size limit of the cache of encoded /api/get responses.
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+
+# Parses the "wait" parameter of /api/get into the long poll's timeout.
+def ParseWait(wait):
+  timeout = float(wait)
+  # Also false for NaN.
+  if not timeout >= 0:
+    raise ValueError(f"Invalid wait: {wait}")
+  return min(timeout, MAX_LONG_POLL_SECONDS)
+
+# Short URLs for the HTML pages. "/" depends on the user agent.
+PATH_ALIASES = {
+  "/m": "/mobile2.html",
+  "/v1": "/index.html",
+  "/m1": "/mobile.html",
+}
+
+REQUIRED = object()
+JSON_BODY = object()
+
+# Precompiles a route table: parameter names become (name, REQUIRED).
+def Routes(table):
+  compiled = {}
+  for key, (handler, params) in table.items():
+    if params is not JSON_BODY:
+      params = tuple((p, REQUIRED) if isinstance(p, str) else p
+                     for p in params)
+    compiled[key] = (handler, params)
+  return compiled
 
 class WineHandler(BaseHTTPRequestHandler):
 
+  # Persistent connections; every response has a Content-Length or is sent
+  # chunked.
+  protocol_version = "HTTP/1.1"
+
   def __init__(self, request, client_address, server):
     self._server = server
     self._basedir = server.basedir
+    # Idle connections are closed after this many seconds.
+    self.timeout = server.keep_alive_timeout
     super().__init__(request, client_address, server)
     self._origin = None  # Will be set later, for each request.
 
-  def _set_headers(self, content_type):
+  # BaseHTTPRequestHandler would write these to stderr directly.
+  def log_message(self, format, *args):
+    logger.info("%s - " + format, self.address_string(), *args)
+
+  def log_error(self, format, *args):
+    # Idle keep-alive connections running into the timeout are expected.
+    level = logging.DEBUG if format.startswith("Request timed out") else \
+        logging.WARNING
+    logger.log(level, "%s - " + format, self.address_string(), *args)
+
+  def handle_one_request(self):
+    self._route = None  # Set by the do_* methods, for metrics.
+    self._status = None
+    try:
+      super().handle_one_request()
+    finally:
+      self._server.manager.ReleaseConnection()
+      metrics = self._server.metrics
+      if metrics is not None and self._route is not None:
+        metrics.ObserveRequest(self.command, self._route, self._status,
+                               time.perf_counter() - self._start)
+
+  def parse_request(self):
+    # Don't count the time spent waiting for the request.
+    self._start = time.perf_counter()
+    return super().parse_request()
+
+  def send_response(self, code, message=None):
+    self._status = code
+    super().send_response(code, message)
+
+  def _set_headers(self, content_type, content_length):
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(content_length))
+    self.send_header("Access-Control-Allow-Origin", self._origin)
+    self.end_headers()
+
+  def _send_asset(self, asset):
+    encoding, body, etag = asset.Select(self.headers['Accept-Encoding'])
+    not_modified = EtagMatches(self.headers['If-None-Match'], etag)
+    if not_modified:
+      self.send_response(304)
+    else:
+      self.send_response(200)
+      self.send_header("Content-Type", asset.mimetype)
+      self.send_header("Content-Length", str(len(body)))
+      if encoding != "identity":
+        self.send_header("Content-Encoding", encoding)
+    self.send_header("ETag", etag)
+    self.send_header("Vary", "Accept-Encoding")
+    # Browsers may cache, but must check with us every time: files change
+    # when the server is updated.
+    self.send_header("Cache-Control", "no-cache")
+    self.send_header("Access-Control-Allow-Origin", self._origin)
+    self.end_headers()
+    if not not_modified:
+      self.wfile.write(body)
+
+  # Sends the byte strings from |chunks| as they are produced, using chunked
+  # transfer encoding for HTTP/1.1 clients. HTTP/1.0 clients get the data
+  # unframed, ending when the connection is closed.
+  def _send_chunked(self, content_type, chunks, headers=None):
+    chunked = self.request_version == "HTTP/1.1"
     self.send_response(200)
     self.send_header("Content-Type", content_type)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    if chunked:
+      self.send_header("Transfer-Encoding", "chunked")
+    else:
+      self.send_header("Connection", "close")
     self.send_header("Access-Control-Allow-Origin", self._origin)
     self.end_headers()
+    for chunk in chunks:
+      if not chunk: continue
+      if chunked:
+        self.wfile.write(b"%X\r\n%s\r\n" % (len(chunk), chunk))
+      else:
+        self.wfile.write(chunk)
+    if chunked:
+      self.wfile.write(b"0\r\n\r\n")
 
   def _send_json(self, data):
-    self._set_headers("application/json")
-    response = urllib.parse.quote(json.dumps(data, sort_keys=True))
-    self.wfile.write(response.encode("utf-8"))
+    body = urllib.parse.quote(json.dumps(data, sort_keys=True)).encode("utf-8")
+    self._set_headers("application/json", len(body))
+    self.wfile.write(body)
 
   def _send_json2(self, data):
-    self._set_headers("application/json")
-    self.wfile.write(json.dumps(data, sort_keys=True).encode("utf-8"))
+    self._send_encoded_json(*EncodeJson(data, self.headers['Accept-Encoding']))
 
-  def do_GET(self):
-    parsed_path = urllib.parse.urlparse(self.path)
-    path = parsed_path.path
-    # We are fine with CORS requests.
-    self._origin = self.headers['Origin']
-
-    if path == "/":
-      user_agent = self.headers['user-agent'].lower()
-      if "android" in user_agent or "mobile" in user_agent:
-        path = "/mobile2.html"
+  def _send_encoded_json(self, body, encoding):
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    if encoding is not None:
+      self.send_header("Content-Encoding", encoding)
+    self.send_header("Vary", "Accept-Encoding")
+    self.send_header("Access-Control-Allow-Origin", self._origin)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _send_metrics(self):
+    metrics = self._server.metrics
+    if metrics is None:
+      self.send_error(404, "Metrics are disabled")
+      return
+    text = metrics.Render(self._server.manager.GetStorageStats())
+    body = text.encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    self.send_header("Access-Control-Allow-Origin", self._origin)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _wait_for_change(self, client_knows_commit, timeout):
+    self._server.manager.WaitForChange(client_knows_commit, timeout)
+
+  # GET handlers. Parameters are passed in the order of the route's spec,
+  # see ROUTES below.
+
+  def _api_get(self, client_knows_commit, wait, response_format, delta,
+               page_size, page_token):
+    # Delta rows leave out unchanged fields, so they have no common keys.
+    if response_format == "columns" and delta == "1":
+      self.send_error(400, "format=columns doesn't support delta=1")
+      return
+    long_poll = wait is not None and page_token is None
+    if long_poll:
+      # Waiting isn't handling time; keep it out of /api/get's latencies.
+      self._route = "/api/get?wait"
+      try:
+        client_commit = int(client_knows_commit)
+        timeout = ParseWait(wait)
+      except ValueError as e:
+        self.send_error(400, str(e))
+        return
+      # Hold the request until there is something new to report.
+      self._wait_for_change(client_commit, timeout)
+    # Only two variants of the body: gzipped or not.
+    gzip_ok = "gzip" in AcceptedEncodings(self.headers['Accept-Encoding'])
+    def Compute():
+      if page_size is not None:
+        response = self._server.manager.GetAll2Page(
+            client_knows_commit, page_size, page_token, delta == "1")
       else:
-        path = "/index2.html"
-    elif path == "/m":
-      path = "/mobile2.html"
-    elif path == "/v1":
-      path = "/index.html"
-    elif path == "/m1":
-      path = "/mobile.html"
-
+        response = self._server.manager.GetAll2(client_knows_commit,
+                                                delta == "1")
+      if long_poll:
+        # Tells the client that it may poll again right away.
+        response["long_poll"] = True
+      if response_format == "columns":
+        response = ToColumns(response)
+      return EncodeJson(response, "gzip" if gzip_ok else None)
+    cache = self._server.response_cache
     try:
-      mimetype = None
-      if path.endswith(".html"):
-        mimetype = "text/html; charset=utf-8"
-      elif path.endswith(".js"):
-        mimetype = "text/javascript"
-      elif path.endswith(".js.map"):
-        mimetype = "application/json"
-      elif path.endswith(".css"):
-        mimetype = "text/css"
-      elif path.endswith(".ts"):
-        mimetype = "application/x-typescript"
-      if mimetype is not None:
-        self._set_headers(mimetype)
-        with open(self._basedir + path, "r", encoding="utf-8") as f:
-          self.wfile.write(f.read().encode('utf-8'))
-        return
-      if path == "/favicon.ico":
-        self._set_headers("image/x-icon")
-        with open(self._basedir + path, "rb") as f:
-          self.wfile.write(f.read())
-    except IOError:
-      self.send_error(404, f"File not found: {self.path}")
+      if cache is None:
+        body, encoding = Compute()
+      else:
+        key = (client_knows_commit, long_poll, response_format, delta,
+               page_size, page_token, gzip_ok)
+        body, encoding = cache.Get(self._server.manager.GetCommit(), key,
+                                   Compute)
+    except ValueError as e:
+      self.send_error(400, str(e))
+      return
+    self._send_encoded_json(body, encoding)
+
+  def _api_search(self, text, limit, only_existing):
+    try:
+      limit = max(0, min(int(limit), MAX_SEARCH_RESULTS))
+    except ValueError:
+      self.send_error(400, f"Invalid limit: {limit}")
+      return
+    results = self._server.manager.Search(text, limit, only_existing != "0")
+    self._send_json2({"results": results})
+
+  def _api_log_series(self, period, start, end, by, wine, vineyard):
+    try:
+      response = self._server.manager.GetLogSeries(period, start, end, by,
+                                                   wine, vineyard)
+    except ValueError as e:
+      self.send_error(400, str(e))
+      return
+    self._send_json2(response)
+
+  def _api_stats(self):
+    gzip_ok = "gzip" in AcceptedEncodings(self.headers['Accept-Encoding'])
+    def Compute():
+      return EncodeJson(self._server.manager.GetStats(),
+                        "gzip" if gzip_ok else None)
+    cache = self._server.response_cache
+    if cache is None:
+      body, encoding = Compute()
+    else:
+      body, encoding = cache.Get(self._server.manager.GetCommit(),
+                                 ("/api/stats", gzip_ok), Compute)
+    self._send_encoded_json(body, encoding)
+
+  def _api_special(self, requested):
+    self._send_json2(self._server.manager.Special(requested))
+
+  def _get_all(self, only_existing):
+    self._send_json(self._server.manager.GetAll(only_existing))
+
+  def _get_sorted(self, only_existing, sortby, limit, page_token, *filters):
+    filters = {name: value for name, value in zip(SORT_FILTERS, filters)
+               if value is not None}
+    manager = self._server.manager
+    try:
+      if limit is None:
+        response = manager.GetSorted(only_existing, sortby, filters)
+      else:
+        response = manager.GetSortedPage(only_existing, sortby, limit,
+                                         page_token, filters)
+    except ValueError as e:
+      self.send_error(400, str(e))
+      return
+    self._send_json(response)
+
+  def _get_vineyards(self):
+    self._send_json(self._server.manager.GetVineyards())
 
-    raw_query = parsed_path.query
-    query = urllib.parse.parse_qs(raw_query)
+  def _get_wines(self, vineyard):
+    self._send_json(self._server.manager.GetWinesForVineyard(vineyard))
 
-    if path == "/api/get":
-      client_knows_commit = query["last_commit"][0]
-      self._send_json2(self._server.manager.GetAll2(client_knows_commit))
+  def _get_log(self, count):
+    self._send_json(self._server.manager.GetLog(count))
 
-    if path == "/api/special":
-      requested = query["type"][0]
-      self._send_json2(self._server.manager.Special(requested))
+  def _vineyard_data(self, vineyard):
+    self._send_json(self._server.manager.GetVineyardData(vineyard))
 
-    elif path == "/get_all":
-      only_existing = query["only_existing"][0]
-      self._send_json(self._server.manager.GetAll(only_existing))
+  def _wine_data(self, wine):
+    self._send_json(self._server.manager.GetWineData(wine))
 
-    elif path == "/get_sorted":
-      only_existing = query["only_existing"][0]
-      sortby = query["sortby"][0]
-      self._send_json(self._server.manager.GetSorted(only_existing, sortby))
+  def _countries(self):
+    self._send_json(self._server.manager.GetCountries())
 
-    elif path == "/get_vineyards":
-      self._send_json(self._server.manager.GetVineyards())
+  def _regions(self, country):
+    self._send_json(self._server.manager.GetRegionsForCountry(country))
 
-    elif path == "/get_wines":
-      wines = self._server.manager.GetWinesForVineyard(query["vineyard"][0])
-      self._send_json(wines)
+  def _grapes(self):
+    self._send_json(self._server.manager.GetGrapes())
 
-    elif path =="/get_log":
-      count = query["count"][0]
-      self._send_json(self._server.manager.GetLog(count))
+  def _get_totals(self):
+    self._send_json(self._server.manager.GetTotals())
 
-    elif path == "/vineyard_data":
-      vineyard = query["vineyard"][0]
-      self._send_json(self._server.manager.GetVineyardData(vineyard))
+  def _export(self):
+    filename = f"wines-{date.today()}.csv"
+    self._send_chunked("text/csv", self._server.manager.ExportCSV(), {
+      "Content-Disposition": f"attachment;filename=\"{filename}\"",
+    })
 
-    elif path =="/wine_data":
-      wine = query["wine"][0]
-      self._send_json(self._server.manager.GetWineData(wine))
+  # POST handlers.
 
-    elif path == "/countries":
-      self._send_json(self._server.manager.GetCountries())
+  def _api_set(self, post_data):
+    logger.debug("request: %s", post_data)
+    self._send_json2(self._server.manager.Set(post_data))
 
-    elif path == "/regions":
-      country = query["country"][0]
-      self._send_json(self._server.manager.GetRegionsForCountry(country))
+  def _api_stock(self, post_data):
+    try:
+      response = self._server.manager.SetStock(post_data["entries"])
+    except (KeyError, TypeError, ValueError) as e:
+      self.send_error(400, f"Invalid stock entries: {e!r}")
+      return
+    self._send_json2(response)
+
+  def _add_all(self, vineyard, wine, year, count, rating, price, comment,
+               reason, only_existing):
+    self._server.manager.AddAll(vineyard, wine, year, count, rating, price,
+                                comment, reason)
+    self._send_json(self._server.manager.GetAll(only_existing))
+
+  def _add_wine(self, vineyard_id, wine, year, count, rating, price, comment,
+                reason, only_existing):
+    self._server.manager.AddWine(vineyard_id, wine, year, count, rating,
+                                 price, comment, reason)
+    self._send_json(self._server.manager.GetAll(only_existing))
+
+  def _add_year(self, wine_id, year, count, rating, price, comment, reason,
+                only_existing):
+    self._server.manager.AddYear(wine_id, year, count, rating, price, comment,
+                                 reason)
+    self._send_json(self._server.manager.GetAll(only_existing))
+
+  def _add_bottle(self, yearid, reason):
+    updated = self._server.manager.AddOneBottle(yearid, reason)
+    self._send_json({"yearid": yearid, "count": updated})
+
+  def _remove_bottle(self, yearid, reason):
+    updated = self._server.manager.RemoveOneBottle(yearid, reason)
+    self._send_json({"yearid": yearid, "count": updated})
+
+  def _add_stock(self, yearid):
+    updated = self._server.manager.AddStock(yearid)
+    self._send_json({"yearid": yearid, "stock": updated})
+
+  def _remove_stock(self, yearid):
+    updated = self._server.manager.RemoveStock(yearid)
+    self._send_json({"yearid": yearid, "stock": updated})
+
+  def _apply_stock(self, yearid):
+    updated = self._server.manager.ApplyStock(yearid)
+    self._send_json({"yearid": yearid, "count": updated})
+
+  def _apply_stock_wine(self, wineid):
+    self._send_json(self._server.manager.ApplyStockWine(wineid))
+
+  def _apply_stock_vineyard(self, vineyard_id):
+    self._send_json(self._server.manager.ApplyStockVineyard(vineyard_id))
+
+  def _apply_stock_all(self):
+    self._send_json(self._server.manager.ApplyStockAll())
+
+  def _reset_stock_all(self):
+    self._server.manager.ResetStockAll()
+    self._send_json({"status": "ok"})
+
+  def _delete_year(self, year_id):
+    self._server.manager.DeleteYear(year_id)
+    self._send_json({"status": "ok"})
+
+  def _update(self, year_id, price, comment):
+    self._server.manager.Update(year_id, price, comment)
+    self._send_json({"status": "ok"})
+
+  def _update_rating(self, year_id, what, val):
+    if what not in ("rating", "value", "sweetness", "age"):
+      self.send_error(400, f"Unknown rating: {what}")
+      return
+    self._server.manager.UpdateRating(year_id, what, val)
+    self._send_json({"yearid": year_id, what: val})
+
+  def _set_vineyard(self, vineyard_id, name, country, region, address,
+                    website, comment):
+    response = self._server.manager.SetVineyardData(
+        vineyard_id, name, country, region, address, website, comment)
+    self._send_json(response)
+
+  def _update_log(self, log_id, reason):
+    self._send_json(self._server.manager.UpdateLog(log_id, reason))
+
+  def _set_wine(self, wine_id, name, grape, comment):
+    self._send_json(self._server.manager.UpdateWine(wine_id, name, grape,
+                                                    comment))
+
+  # (method, path) -> (handler, parameters). A parameter is either a name,
+  # for required ones, or a (name, default) pair. JSON_BODY passes the
+  # decoded JSON body instead.
+  ROUTES = Routes({
+    ("GET", "/api/get"): (_api_get, [
+        "last_commit", ("wait", None), ("format", None), ("delta", None),
+        ("page_size", None), ("page_token", None)]),
+    ("GET", "/api/search"): (_api_search, [
+        "q", ("limit", "50"), ("only_existing", "1")]),
+    ("GET", "/api/special"): (_api_special, ["type"]),
+    ("GET", "/api/stats"): (_api_stats, []),
+    ("GET", "/api/log_series"): (_api_log_series, [
+        ("period", "month"), ("from", None), ("to", None), ("by", "total"),
+        ("wine", None), ("vineyard", None)]),
+    ("GET", "/api/metrics"): (_send_metrics, []),
+    ("GET", "/api/export"): (_export, []),
+    ("GET", "/export"): (_export, []),
+    ("GET", "/get_all"): (_get_all, ["only_existing"]),
+    ("GET", "/get_sorted"): (_get_sorted, [
+        "only_existing", "sortby", ("limit", None), ("page_token", None)] +
+        [(name, None) for name in SORT_FILTERS]),
+    ("GET", "/get_vineyards"): (_get_vineyards, []),
+    ("GET", "/get_wines"): (_get_wines, ["vineyard"]),
+    ("GET", "/get_log"): (_get_log, ["count"]),
+    ("GET", "/vineyard_data"): (_vineyard_data, ["vineyard"]),
+    ("GET", "/wine_data"): (_wine_data, ["wine"]),
+    ("GET", "/countries"): (_countries, []),
+    ("GET", "/regions"): (_regions, ["country"]),
+    ("GET", "/grapes"): (_grapes, []),
+    ("GET", "/get_totals"): (_get_totals, []),
+
+    ("POST", "/api/set"): (_api_set, JSON_BODY),
+    ("POST", "/api/stock"): (_api_stock, JSON_BODY),
+    ("POST", "/add_all"): (_add_all, [
+        "vineyard", "wine", "year", ("count", 0), ("rating", 0),
+        ("price", 0), ("comment", ""), "reason", "only_existing"]),
+    ("POST", "/add_wine"): (_add_wine, [
+        "vineyard_id", "wine", "year", ("count", 0), ("rating", 0),
+        ("price", 0), ("comment", ""), "reason", "only_existing"]),
+    ("POST", "/add_year"): (_add_year, [
+        "wine_id", "year", ("count", 0), ("rating", 0), ("price", 0),
+        ("comment", ""), "reason", "only_existing"]),
+    ("POST", "/add_bottle"): (_add_bottle, ["yearid", "reason"]),
+    ("POST", "/remove_bottle"): (_remove_bottle, ["yearid", "reason"]),
+    ("POST", "/add_stock"): (_add_stock, ["yearid"]),
+    ("POST", "/remove_stock"): (_remove_stock, ["yearid"]),
+    ("POST", "/apply_stock"): (_apply_stock, ["yearid"]),
+    ("POST", "/apply_stock_wine"): (_apply_stock_wine, ["wineid"]),
+    ("POST", "/apply_stock_vineyard"): (_apply_stock_vineyard,
+                                        ["vineyard_id"]),
+    ("POST", "/apply_stock_all"): (_apply_stock_all, []),
+    ("POST", "/reset_stock_all"): (_reset_stock_all, []),
+    ("POST", "/delete_year"): (_delete_year, ["year_id"]),
+    ("POST", "/update"): (_update, [
+        "year_id", ("price", 0), ("comment", "")]),
+    ("POST", "/update_rating"): (_update_rating, ["year_id", "what", "val"]),
+    ("POST", "/set_vineyard"): (_set_vineyard, [
+        "vineyard_id", ("name", ""), ("country", ""), ("region", ""),
+        ("address", ""), ("website", ""), ("comment", "")]),
+    ("POST", "/update_log"): (_update_log, ["log_id", "reason"]),
+    ("POST", "/set_wine"): (_set_wine, [
+        "wine_id", "name", ("grape", ""), ("comment", "")]),
+  })
+
+  # Calls the handler of |route| with the parameters taken from |values|
+  # (parse_qs output), or sends a 400 error if a required one is missing.
+  def _dispatch(self, route, values, strip):
+    handler, params = route
+    args = []
+    for name, default in params:
+      if name in values:
+        value = values[name][0]
+        args.append(value.strip() if strip else value)
+      elif default is REQUIRED:
+        self.send_error(400, f"Missing parameter: {name}")
+        return
+      else:
+        args.append(default)
+    handler(self, *args)
+
+  def do_GET(self):
+    parsed_path = urllib.parse.urlparse(self.path)
+    path = parsed_path.path
+    # We are fine with CORS requests.
+    self._origin = self.headers['Origin']
 
-    elif path == "/grapes":
-      self._send_json(self._server.manager.GetGrapes())
+    route = WineHandler.ROUTES.get(("GET", path))
+    if route is not None:
+      self._route = path
+      query = urllib.parse.parse_qs(parsed_path.query)
+      self._dispatch(route, query, strip=False)
+      return
 
-    elif path == "/get_totals":
-      self._send_json(self._server.manager.GetTotals())
+    if path == "/":
+      user_agent = self.headers['user-agent'].lower()
+      if "android" in user_agent or "mobile" in user_agent:
+        path = "/mobile2.html"
+      else:
+        path = "/index2.html"
+    else:
+      path = PATH_ALIASES.get(path, path)
 
-    elif path == "/export" or path == "/api/export":
-      self.send_response(200)
-      self.send_header("Content-type", "text/csv")
-      filename = f"wines-{date.today()}.csv"
-      self.send_header("Content-Disposition",
-                       f"attachment;filename=\"{filename}\"")
-      self.end_headers()
-      result = self._server.manager.ExportCSV()
-      self.wfile.write(result.encode('utf-8'))
-
-  def _get_post_data(self, option):
-    return self._post_data[option][0].strip()
-
-  def _get_optional(self, option, default):
-    if option in self._post_data:
-      return self._post_data[option][0].strip()
-    return default
+    self._route = "static"
+    asset = self._server.assets.Get(path)
+    if asset is None:
+      self.send_error(404, f"File not found: {self.path}")
+    else:
+      self._send_asset(asset)
 
   def do_POST(self):
     # We are fine with CORS requests.
     self._origin = self.headers['Origin']
-    content_length = int(self.headers['Content-Length'])
-    raw = str(self.rfile.read(content_length), encoding='utf-8')
-    content_type = self.headers['Content-Type']
-    if content_type == "application/x-www-form-urlencoded":
-      # The v1 way of doing things.
-      self._post_data = urllib.parse.parse_qs(raw)
-    elif content_type == "application/json":
+    content_length = int(self.headers['Content-Length'] or 0)
+    raw = DecodeBody(self.rfile.read(content_length),
+                     self.headers['Content-Encoding'])
+    route = WineHandler.ROUTES.get(("POST", self.path))
+    if route is None:
+      self.send_error(404, f"Unknown request: {self.path}")
+      return
+    self._route = self.path
+    handler, params = route
+    content_type = self.headers['Content-Type'] or ""
+    if params is JSON_BODY:
+      if content_type.split(";")[0] != "application/json":
+        self.send_error(415, f"Expected JSON, got {content_type}")
+        return
       # The v2 way of doing things.
-      post_data = json.loads(raw)
-
-    if self.path == "/api/set":
-      print(f"request: {post_data}")
-      response = self._server.manager.Set(post_data)
-      self._send_json2(response)
-
-    elif self.path == "/add_all":
-      vineyard = self._get_post_data("vineyard")
-      wine = self._get_post_data("wine")
-      year = self._get_post_data("year")
-      count = self._get_optional("count", 0)
-      rating = self._get_optional("rating", 0)
-      price = self._get_optional("price", 0)
-      comment = self._get_optional("comment", "")
-      reason = self._get_post_data("reason")
-      only_existing = self._get_post_data("only_existing")
-      self._server.manager.AddAll(vineyard, wine, year, count, rating, price,
-                                  comment, reason)
-      self._send_json(self._server.manager.GetAll(only_existing))
-
-    elif self.path == "/add_wine":
-      vineyard_id = self._get_post_data("vineyard_id")
-      wine = self._get_post_data("wine")
-      year = self._get_post_data("year")
-      count = self._get_optional("count", 0)
-      rating = self._get_optional("rating", 0)
-      price = self._get_optional("price", 0)
-      comment = self._get_optional("comment", "")
-      reason = self._get_post_data("reason")
-      only_existing = self._get_post_data("only_existing")
-      self._server.manager.AddWine(vineyard_id, wine, year, count, rating,
-                                   price, comment, reason)
-      self._send_json(self._server.manager.GetAll(only_existing))
-
-    elif self.path == "/add_year":
-      wine_id = self._get_post_data("wine_id")
-      year = self._get_post_data("year")
-      count = self._get_optional("count", 0)
-      rating = self._get_optional("rating", 0)
-      price = self._get_optional("price", 0)
-      comment = self._get_optional("comment", "")
-      reason = self._get_post_data("reason")
-      only_existing = self._get_post_data("only_existing")
-      self._server.manager.AddYear(wine_id, year, count, rating, price, comment,
-                                   reason)
-      self._send_json(self._server.manager.GetAll(only_existing))
-
-    elif self.path == "/add_bottle":
-      yearid = self._get_post_data("yearid")
-      reason = self._get_post_data("reason")
-      updated = self._server.manager.AddOneBottle(yearid, reason)
-      self._send_json({"yearid": yearid, "count": updated})
-
-    elif self.path == "/remove_bottle":
-      yearid = self._get_post_data("yearid")
-      reason = self._get_post_data("reason")
-      updated = self._server.manager.RemoveOneBottle(yearid, reason)
-      self._send_json({"yearid": yearid, "count": updated})
-
-    elif self.path == "/add_stock":
-      yearid = self._get_post_data("yearid")
-      updated = self._server.manager.AddStock(yearid)
-      self._send_json({"yearid": yearid, "stock": updated})
-
-    elif self.path == "/remove_stock":
-      yearid = self._get_post_data("yearid")
-      updated = self._server.manager.RemoveStock(yearid)
-      self._send_json({"yearid": yearid, "stock": updated})
-
-    elif self.path == "/apply_stock":
-      yearid = self._get_post_data("yearid")
-      updated = self._server.manager.ApplyStock(yearid)
-      self._send_json({"yearid": yearid, "count": updated})
-
-    elif self.path == "/apply_stock_wine":
-      wineid = self._get_post_data("wineid")
-      result = self._server.manager.ApplyStockWine(wineid)
-      self._send_json(result)
-
-    elif self.path == "/apply_stock_vineyard":
-      vineyard_id = self._get_post_data("vineyard_id")
-      result = self._server.manager.ApplyStockVineyard(vineyard_id)
-      self._send_json(result)
-
-    elif self.path == "/apply_stock_all":
-      self._send_json(self._server.manager.ApplyStockAll())
-
-    elif self.path == "/reset_stock_all":
-      self._server.manager.ResetStockAll()
-      self._send_json({"status": "ok"})
-
-    elif self.path == "/delete_year":
-      year_id = self._get_post_data("year_id")
-      self._server.manager.DeleteYear(year_id)
-      self._send_json({"status": "ok"})
-
-    elif self.path == "/update":
-      year_id = self._get_post_data("year_id")
-      price = self._get_optional("price", 0)
-      comment = self._get_optional("comment", "")
-      self._server.manager.Update(year_id, price, comment)
-      self._send_json({"status": "ok"})
-
-    elif self.path == "/update_rating":
-      year_id = self._get_post_data("year_id")
-      what = self._get_post_data("what")
-      if what not in ("rating", "value", "sweetness", "age"): return
-      val = self._get_post_data("val")
-      self._server.manager.UpdateRating(year_id, what, val)
-      self._send_json({"yearid": year_id, what: val})
-
-    elif self.path == "/set_vineyard":
-      vineyard_id = self._get_post_data("vineyard_id")
-      name = self._get_optional("name", "")
-      country = self._get_optional("country", "")
-      region = self._get_optional("region", "")
-      address = self._get_optional("address", "")
-      website = self._get_optional("website", "")
-      comment = self._get_optional("comment", "")
-      response = self._server.manager.SetVineyardData(
-          vineyard_id, name, country, region, address, website, comment)
-      self._send_json(response)
-
-    elif self.path == "/update_log":
-      log_id = self._get_post_data("log_id")
-      reason = self._get_post_data("reason")
-      self._send_json(self._server.manager.UpdateLog(log_id, reason))
-
-    elif self.path == "/set_wine":
-      wine_id = self._get_post_data("wine_id")
-      name = self._get_post_data("name")
-      grape = self._get_optional("grape", "")
-      comment = self._get_optional("comment", "")
-      response = self._server.manager.UpdateWine(wine_id, name, grape, comment)
-      self._send_json(response)
+      handler(self, FromColumns(json.loads(raw)))
+    else:
+      # The v1 way of doing things.
+      self._dispatch(route, urllib.parse.parse_qs(raw), strip=True)
 
   def do_OPTIONS(self):
     # POST requests in offline mode require this for "pre-flighting" requests.
     self.send_response(204)
     self.send_header('Access-Control-Allow-Origin', self.headers['Origin'])
     self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-    self.send_header('Access-Control-Allow-Headers', 'Content-type')
+    self.send_header('Access-Control-Allow-Headers',
+                     'Content-type, Content-Encoding')
     self.end_headers()
 
-class WineServer(HTTPServer):
-  def __init__(self, port, db_file, basedir):
+# Each request is handled on its own thread; the Manager serializes writes
+# and gives every thread its own read connection.
+class WineServer(ThreadingHTTPServer):
+  def __init__(self, port, db_file, basedir, manager_options=None,
+               metrics=False, keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+               response_cache_bytes=RESPONSE_CACHE_BYTES):
     super().__init__(('', port), WineHandler)
     self.manager = None
     self.thread = None
     self.db_file = db_file
+    self.manager_options = manager_options or {}
     self.basedir = basedir
+    self.assets = AssetCache(basedir)
+    self.metrics = Metrics() if metrics else None
+    self.keep_alive_timeout = keep_alive_timeout
+    self.response_cache = (ResponseCache(response_cache_bytes)
+                           if response_cache_bytes > 0 else None)
     self.shutdown_done = threading.Event()
 
   def Start(self):
@@ -313,7 +578,11 @@ class WineServer(HTTPServer):
     self.thread.start()
 
   def _Run(self):
-    self.manager = Manager(self.db_file)
+    self.manager = Manager(self.db_file, metrics=self.metrics,
+                           **self.manager_options)
+    if self.response_cache is not None:
+      self.response_cache.Invalidate(self.manager.GetCommit())
+      self.manager.AddChangeListener(self.response_cache.Invalidate)
     print(f"Server läuft auf Port {self.server_address[1]}")
     try:
       self.serve_forever()
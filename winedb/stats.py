@@ -0,0 +1,113 @@
+import threading
+
+# The breakdowns of /api/stats: name -> SQL expression for a year's group.
+STATS_DIMENSIONS = {
+  "country": "COALESCE(vineyards.country, '')",
+  "region": "COALESCE(vineyards.region, '')",
+  "grape": "COALESCE(wines.grape, '')",
+  "vintage": "years.year",
+  "location": "COALESCE(years.location, '')",
+  # Whole stars; half stars count towards the lower band.
+  "rating": "CAST(COALESCE(years.rating, 0) AS INTEGER)",
+}
+
+# Beyond this many changed years, recomputing everything is cheaper.
+MAX_INCREMENTAL_YEARS = 500
+
+_FROM = """
+  FROM years
+  INNER JOIN wines ON years.wine = wines.id
+  INNER JOIN vineyards ON wines.vineyard = vineyards.id"""
+
+_KEYS = ", ".join(f"{expression} AS {name}"
+                  for name, expression in STATS_DIMENSIONS.items())
+
+_YEAR_COLUMNS = f"""years.id AS id, years.count AS count,
+  years.price AS price, {_KEYS}"""
+
+# Years changed after a commit, including those whose wine or vineyard
+# changed: they may have moved to another group.
+_CHANGED_YEARS = f"""
+  SELECT {_YEAR_COLUMNS} {_FROM}
+  WHERE years.id IN (
+    SELECT id FROM years WHERE lastchange > ?1
+    UNION
+    SELECT id FROM years WHERE wine IN (
+      SELECT id FROM wines WHERE lastchange > ?1)
+    UNION
+    SELECT id FROM years WHERE wine IN (
+      SELECT id FROM wines WHERE vineyard IN (
+        SELECT id FROM vineyards WHERE lastchange > ?1)))"""
+
+# Bottles and their value (count * price) per group, for the years with
+# count > 0. Computed with GROUP BY and kept per commit; after writes, only
+# the changed years are read, and their old and new contributions moved
+# between the groups they left and joined.
+class StatsCache:
+  def __init__(self, manager):
+    self._manager = manager
+    self._lock = threading.Lock()
+    self._commit = None
+    self._groups = {name: {} for name in STATS_DIMENSIONS}
+    # Year id -> (its group per dimension, bottles, value), for the years
+    # counted.
+    self._members = {}
+
+  # Must be called in a Snapshot of |commit|.
+  def Get(self, commit):
+    with self._lock:
+      if self._commit != commit:
+        changed = None
+        if self._commit is not None:
+          changed = list(self._manager.Execute(
+              _CHANGED_YEARS + f" LIMIT {MAX_INCREMENTAL_YEARS + 1}",
+              (self._commit,)))
+        if changed is None or len(changed) > MAX_INCREMENTAL_YEARS:
+          self._Rebuild()
+        else:
+          self._Update(changed)
+        self._commit = commit
+      result = {"commit": commit}
+      for name, groups in self._groups.items():
+        result[name] = [
+          {"key": key, "bottles": bottles, "value": round(value, 2)}
+          for key, (bottles, value) in sorted(groups.items())]
+      return result
+
+  def _Rebuild(self):
+    self._members = {}
+    for row in self._manager.Execute(
+        f"SELECT {_YEAR_COLUMNS} {_FROM} WHERE years.count > 0"):
+      self._members[row["id"]] = _Member(row)
+    for name, expression in STATS_DIMENSIONS.items():
+      c = self._manager.Execute(f"""
+        SELECT {expression} AS key, SUM(years.count) AS bottles,
+               TOTAL(years.count * years.price) AS value
+        {_FROM}
+        WHERE years.count > 0
+        GROUP BY key""")
+      self._groups[name] = {row["key"]: (row["bottles"], row["value"])
+                            for row in c}
+
+  def _Update(self, changed):
+    for row in changed:
+      old = self._members.pop(row["id"], None)
+      if old is not None: self._Add(old, -1)
+      if row["count"] > 0:
+        new = self._members[row["id"]] = _Member(row)
+        self._Add(new, 1)
+
+  def _Add(self, member, sign):
+    keys, bottles, value = member
+    for name, key in zip(STATS_DIMENSIONS, keys):
+      groups = self._groups[name]
+      total_bottles, total_value = groups.get(key, (0, 0.0))
+      total_bottles += sign * bottles
+      if total_bottles == 0:
+        del groups[key]
+      else:
+        groups[key] = (total_bottles, total_value + sign * value)
+
+def _Member(row):
+  return (tuple(row[name] for name in STATS_DIMENSIONS), row["count"],
+          row["count"] * (row["price"] or 0))